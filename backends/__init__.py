@@ -0,0 +1,19 @@
+import importlib
+
+# backend name: module and class, imported only when the backend is selected so arcpy is never imported on
+# machines that run the gdal backend
+BACKENDS = {'arcpy': ('backends.arcpy_backend', 'ArcpyBackend'),
+            'gdal': ('backends.gdal_backend', 'GdalBackend')}
+
+
+def open_backend(name='arcpy'):
+    """
+    Return the raster backend called name
+    :param name: arcpy (file geodatabase mosaics, arcpy.sa) or gdal (GeoTIFF/VRT read with rasterio)
+    """
+    if name not in BACKENDS:
+        raise ValueError("unknown backend {}, use {}".format(name, " or ".join(sorted(BACKENDS))))
+
+    module_name, class_name = BACKENDS[name]
+
+    return getattr(importlib.import_module(module_name), class_name)()
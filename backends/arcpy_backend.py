@@ -0,0 +1,155 @@
+import os
+import math
+import arcpy
+import shapely
+
+from utilities import checkpoint, prep_shapefile, zstats_handler
+
+# arcpy.Raster objects made by this process, kept across chunks and runs: {path: (raster, modified time)}
+_rasters = {}
+_rasters_pid = None
+
+
+def cached_raster(path):
+    """
+    arcpy.Raster for path, reusing the one made earlier by this process unless the geodatabase changed since
+    """
+    global _rasters_pid
+
+    if _rasters_pid != os.getpid():
+        _rasters.clear()
+        _rasters_pid = os.getpid()
+
+    mtime = checkpoint.path_mtime(path)
+    if path not in _rasters or _rasters[path][1] != mtime:
+        _rasters[path] = (arcpy.Raster(path), mtime)
+
+    return _rasters[path][0]
+
+
+class ArcpyBackend(object):
+    """ Rasters are mosaics in a file geodatabase (with the Arithmetic and Remap functions applied to them) and the
+    aoi is prepared with arcpy. Needs ArcGIS and the Spatial Analyst extension
+    :return:
+    """
+
+    name = 'arcpy'
+
+    # arcpy is not thread safe, its rasters are only read from the thread that runs the chunk
+    thread_safe = False
+
+    def project(self, source_aoi, out_aoi, out_cs):
+        arcpy.env.overwriteOutput = True
+        arcpy.Project_management(source_aoi, out_aoi, arcpy.SpatialReference(out_cs))
+
+    def intersect(self, shapefile, intersect, intersect_col, workspace, out_final_aoi, dissolve=True):
+        return prep_shapefile.intersect_gp(shapefile, intersect, intersect_col, workspace, out_final_aoi, dissolve)
+
+    def geometry_hashes(self, final_aoi):
+        """
+        Hash each feature's geometry, keyed on FID, so an incremental run can tell which features changed
+        """
+        with arcpy.da.SearchCursor(final_aoi, ["OID@", "SHAPE@WKB"]) as cursor:
+            return {int(oid): checkpoint.geometry_hash(wkb) for oid, wkb in cursor}
+
+    def feature_bounds(self, final_aoi, raster):
+        """
+        Bounding box of each feature, keyed on FID. The aoi is projected to the rasters' coordinate system already
+        """
+        with arcpy.da.SearchCursor(final_aoi, ["OID@", "SHAPE@"]) as cursor:
+            return {int(oid): (shape.extent.XMin, shape.extent.YMin, shape.extent.XMax, shape.extent.YMax)
+                    for oid, shape in cursor if shape is not None}
+
+    def footprints(self, path):
+        """
+        Footprint of every item of the mosaic dataset at path, or the extent of a plain raster
+        """
+        desc = arcpy.Describe(path)
+
+        if desc.datasetType == 'MosaicDataset':
+            with arcpy.da.SearchCursor(os.path.join(path, 'Footprint'), ["SHAPE@WKB"]) as cursor:
+                footprints = [shapely.from_wkb(bytes(wkb)) for wkb, in cursor if wkb is not None]
+            if footprints:
+                return footprints
+
+        extent = desc.extent
+
+        return [shapely.box(extent.XMin, extent.YMin, extent.XMax, extent.YMax)]
+
+    def feature_grid(self, final_aoi, feature_ids, rasters, worker=None):
+        return ArcpyFeatureGrid(final_aoi, feature_ids, rasters, worker)
+
+
+class ArcpyFeatureGrid(object):
+    """ The first raster's grid cut to the union extent of the features in feature_ids. The features are kept as
+    geometries, the engine finds the cells each of them covers (see cell_coverage.FeatureIndex), and windows of the
+    rasters are read with RasterToNumPyArray
+    :param rasters: paths of the rasters to read, they have to be on the same grid
+    :return:
+    """
+
+    def __init__(self, final_aoi, feature_ids, rasters, worker=None):
+        arcpy.env.overwriteOutput = True
+
+        suffix = '' if worker is None else '_{}'.format(worker)
+
+        self.rasters = {path: cached_raster(path) for path in rasters}
+        self.cellsize = self.rasters[rasters[0]].meanCellWidth
+
+        # the arrays are read at each raster's own resolution, so they all have to be on the same grid
+        for path in rasters:
+            if self.rasters[path].meanCellWidth != self.cellsize:
+                raise ValueError("rasters {} and {} have different cell sizes, "
+                                 "use engine = arcpy".format(rasters[0], path))
+
+        exp = zstats_handler.fid_where(feature_ids)
+        self.features = arcpy.MakeFeatureLayer_management(final_aoi, "chunk{}".format(suffix), exp).getOutput(0)
+
+        # row, col of the top left cell under the features in the first raster, and the size of the grid
+        grid_ras = self.rasters[rasters[0]]
+        extent = grid_ras.extent
+        features_extent = arcpy.Describe(self.features).extent
+
+        self.col0 = max(int(math.floor((features_extent.XMin - extent.XMin) / self.cellsize)), 0)
+        self.row0 = max(int(math.floor((extent.YMax - features_extent.YMax) / self.cellsize)), 0)
+        col1 = min(int(math.ceil((features_extent.XMax - extent.XMin) / self.cellsize)), grid_ras.width)
+        row1 = min(int(math.ceil((extent.YMax - features_extent.YMin) / self.cellsize)), grid_ras.height)
+        self.width = max(col1 - self.col0, 0)
+        self.height = max(row1 - self.row0, 0)
+
+        self.xmin = extent.XMin + self.col0 * self.cellsize
+        self.ymax = extent.YMax - self.row0 * self.cellsize
+
+    def lower_left(self, window):
+        row_off, col_off, nrows, ncols = window
+
+        return arcpy.Point(self.xmin + col_off * self.cellsize, self.ymax - (row_off + nrows) * self.cellsize)
+
+    def geometries(self):
+        """
+        (geometry, FID) of the features of the chunk, as shapely geometries
+        """
+        with arcpy.da.SearchCursor(self.features, ["OID@", "SHAPE@WKB"]) as cursor:
+            return [(shapely.from_wkb(bytes(wkb)), int(oid)) for oid, wkb in cursor]
+
+    def cell_size(self):
+        return self.cellsize, self.cellsize
+
+    def window_origin(self, window):
+        """
+        x, y of the top left corner of window
+        """
+        row_off, col_off, nrows, ncols = window
+
+        return self.xmin + col_off * self.cellsize, self.ymax - row_off * self.cellsize
+
+    def read(self, path, window):
+        """
+        Read window of the raster at path, no data is read as 0
+        """
+        row_off, col_off, nrows, ncols = window
+
+        return arcpy.RasterToNumPyArray(self.rasters[path], self.lower_left(window), ncols, nrows, nodata_to_value=0)
+
+    def close(self):
+        arcpy.Delete_management(self.features)
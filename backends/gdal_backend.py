@@ -0,0 +1,248 @@
+import os
+import math
+import numpy as np
+import geopandas as gpd
+import rasterio
+import shapely
+import xml.etree.ElementTree as ET
+from affine import Affine
+from rasterio.windows import Window
+
+from utilities import aoi_reader, checkpoint
+
+# tried in this order when a raster is named without its extension, like loss or area in the config file
+RASTER_EXTENSIONS = ['.vrt', '.tif', '.tiff']
+
+
+def open_raster(path):
+    """
+    Open a GeoTIFF, Cloud Optimized GeoTIFF or VRT with rasterio
+    """
+    if not os.path.exists(path):
+        for ext in RASTER_EXTENSIONS:
+            if os.path.exists(path + ext):
+                path = path + ext
+                break
+
+    return rasterio.open(path)
+
+
+# rasters opened by this process, kept open across chunks and runs: {path: (dataset, modified time)}
+_datasets = {}
+_datasets_pid = None
+
+
+def cached_raster(path):
+    """
+    open_raster, reusing the dataset opened for path earlier by this process unless the file changed since. A
+    forked worker opens its own datasets instead of sharing the parent's file handles
+    """
+    global _datasets_pid
+
+    if _datasets_pid != os.getpid():
+        _datasets.clear()
+        _datasets_pid = os.getpid()
+
+    mtime = checkpoint.path_mtime(path)
+    if path not in _datasets or _datasets[path][1] != mtime:
+        if path in _datasets:
+            _datasets[path][0].close()
+        _datasets[path] = (open_raster(path), mtime)
+
+    return _datasets[path][0]
+
+
+def shift(transform, rows, cols):
+    """
+    transform of the grid that starts rows, cols cells into the grid of transform
+    """
+    t = transform
+
+    return Affine(t.a, t.b, t.c + cols * t.a + rows * t.b, t.d, t.e, t.f + cols * t.d + rows * t.e)
+
+
+def grid_bounds(transform, row_off, col_off, nrows, ncols):
+    """
+    xmin, ymin, xmax, ymax of the nrows x ncols cells starting row_off, col_off into the grid of transform
+    """
+    t = shift(transform, row_off, col_off)
+    xs = [t.c, t.c + ncols * t.a]
+    ys = [t.f, t.f + nrows * t.e]
+
+    return min(xs), min(ys), max(xs), max(ys)
+
+
+def vrt_footprints(src):
+    """
+    Extent of each source file of a VRT, from the DstRect of its sources in the first band
+    """
+    band = ET.parse(src.name).getroot().find("VRTRasterBand[@band='1']")
+    rects = band.iter('DstRect') if band is not None else []
+
+    return [shapely.box(*grid_bounds(src.transform, float(rect.get('yOff')), float(rect.get('xOff')),
+                                     float(rect.get('ySize')), float(rect.get('xSize')))) for rect in rects]
+
+
+def read_features(final_aoi, feature_ids):
+    """
+    The rows of final_aoi for feature_ids, indexed by FID (the row position in the shapefile)
+    """
+    start, stop = int(feature_ids[0]), int(feature_ids[-1]) + 1
+
+    gdf = aoi_reader.read_features(final_aoi, rows=(start, stop))
+
+    return gdf[gdf.index.isin(feature_ids) & gdf.geometry.notna()]
+
+
+class GdalBackend(object):
+    """ Rasters are GeoTIFF or VRT files read window by window with rasterio, and the aoi is prepared with
+    geopandas, so nothing needs arcpy. geodatabase in the config file is the folder holding the rasters. Unless
+    raster_functions = numpy, the loss raster has to hold the loss + tcd code and the biomass raster
+    biomass x area / 10000, like the mosaics with their Arithmetic functions
+    :return:
+    """
+
+    name = 'gdal'
+
+    # windows can be read ahead in a background thread: only that thread reads the datasets while a chunk runs
+    thread_safe = True
+
+    def project(self, source_aoi, out_aoi, out_cs):
+        aoi_reader.read_features(source_aoi).to_crs(epsg=out_cs).to_file(out_aoi)
+
+    def intersect(self, shapefile, intersect, intersect_col, workspace, out_final_aoi, dissolve=True):
+        aoi = aoi_reader.read_features(shapefile)
+        boundary = aoi_reader.read_features(intersect).to_crs(aoi.crs)
+
+        intersected = gpd.overlay(aoi, boundary, how='intersection')
+
+        # without the dissolve every piece is kept, with the columns of both files, and grouped after zonal stats
+        if dissolve:
+            intersected = intersected[intersect_col + ['geometry']].dissolve(by=intersect_col).reset_index()
+        intersected.to_file(out_final_aoi)
+
+        print("intersected with boundary\n")
+
+        return out_final_aoi
+
+    def geometry_hashes(self, final_aoi):
+        """
+        Hash each feature's geometry, keyed on FID, so an incremental run can tell which features changed
+        """
+        geometry = aoi_reader.read_features(final_aoi, columns=[]).geometry
+        wkbs = shapely.to_wkb(geometry.values)
+
+        return {i: checkpoint.geometry_hash(wkb if wkb is not None else b'') for i, wkb in enumerate(wkbs)}
+
+    def feature_bounds(self, final_aoi, raster):
+        """
+        Bounding box of each feature, keyed on FID, in the coordinates of raster
+        """
+        gdf = aoi_reader.read_features(final_aoi, columns=[])
+        with open_raster(raster) as src:
+            if gdf.crs is not None and src.crs is not None and gdf.crs != src.crs:
+                gdf = gdf.to_crs(src.crs)
+
+        gdf = gdf[gdf.geometry.notna() & ~gdf.geometry.is_empty]
+
+        return dict(zip(gdf.index.astype(int), map(tuple, gdf.geometry.bounds.values)))
+
+    def footprints(self, path):
+        """
+        Footprint of every file the raster at path is made of: each source of a VRT, or the raster itself
+        """
+        with open_raster(path) as src:
+            if src.driver == 'VRT':
+                footprints = vrt_footprints(src)
+                if footprints:
+                    return footprints
+
+            return [shapely.box(*grid_bounds(src.transform, 0, 0, src.height, src.width))]
+
+    def feature_grid(self, final_aoi, feature_ids, rasters, worker=None):
+        return GdalFeatureGrid(final_aoi, feature_ids, rasters)
+
+
+class GdalFeatureGrid(object):
+    """ The first raster's grid cut to the union extent of the features in feature_ids. The features are kept as
+    geometries, the engine finds the cells each of them covers (see cell_coverage.FeatureIndex), so there is no
+    feature ID raster on disk
+    :param rasters: paths of the rasters to read, they have to have the same cell size and be aligned
+    :return:
+    """
+
+    def __init__(self, final_aoi, feature_ids, rasters):
+        self.srcs = {path: cached_raster(path) for path in rasters}
+        grid_src = self.srcs[rasters[0]]
+        transform = grid_src.transform
+
+        # row, col offset of each raster from the first one
+        self.offsets = {}
+        for path, src in self.srcs.items():
+            col = (transform.c - src.transform.c) / src.transform.a
+            row = (transform.f - src.transform.f) / src.transform.e
+
+            same_cellsize = np.allclose([src.transform.a, src.transform.e], [transform.a, transform.e])
+            if not same_cellsize or abs(col - round(col)) > 1e-6 or abs(row - round(row)) > 1e-6:
+                raise ValueError("rasters {} and {} are not on the same grid".format(rasters[0], path))
+            self.offsets[path] = (int(round(row)), int(round(col)))
+
+        gdf = read_features(final_aoi, feature_ids)
+        if gdf.crs is not None and grid_src.crs is not None and gdf.crs != grid_src.crs:
+            gdf = gdf.to_crs(grid_src.crs)
+        self.shapes = list(zip(gdf.geometry, gdf.index.astype(int)))
+
+        if gdf.empty:
+            self.row0 = self.col0 = self.height = self.width = 0
+        else:
+            xmin, ymin, xmax, ymax = gdf.total_bounds
+            col1 = min(int(math.ceil((xmax - transform.c) / transform.a)), grid_src.width)
+            row1 = min(int(math.ceil((ymin - transform.f) / transform.e)), grid_src.height)
+
+            self.col0 = max(int(math.floor((xmin - transform.c) / transform.a)), 0)
+            self.row0 = max(int(math.floor((ymax - transform.f) / transform.e)), 0)
+            self.width = max(col1 - self.col0, 0)
+            self.height = max(row1 - self.row0, 0)
+
+        self.transform = shift(transform, self.row0, self.col0)
+
+    def geometries(self):
+        return self.shapes
+
+    def cell_size(self):
+        return self.transform.a, -self.transform.e
+
+    def window_origin(self, window):
+        """
+        x, y of the top left corner of window
+        """
+        transform = shift(self.transform, window[0], window[1])
+
+        return transform.c, transform.f
+
+    def read(self, path, window):
+        """
+        Read window of the raster at path, cells outside the raster or equal to its nodata are read as 0
+        """
+        src = self.srcs[path]
+        row_off, col_off, nrows, ncols = window
+        row = self.row0 + row_off + self.offsets[path][0]
+        col = self.col0 + col_off + self.offsets[path][1]
+
+        out = np.zeros((nrows, ncols), dtype=src.dtypes[0])
+        r0, c0 = max(row, 0), max(col, 0)
+        r1, c1 = min(row + nrows, src.height), min(col + ncols, src.width)
+
+        if r1 > r0 and c1 > c0:
+            data = src.read(1, window=Window(c0, r0, c1 - c0, r1 - r0))
+
+            if src.nodata is not None:
+                nodata = np.isnan(data) if np.isnan(src.nodata) else data == src.nodata
+                data[nodata] = 0
+            out[r0 - row:r1 - row, c0 - col:c1 - col] = data
+
+        return out
+
+    def close(self):
+        # the datasets stay open for the next chunk, see cached_raster
+        self.srcs = {}
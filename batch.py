@@ -0,0 +1,101 @@
+import os
+import argparse
+import datetime
+import logging
+import traceback
+import configparser
+from concurrent.futures import ProcessPoolExecutor
+
+import zonal_stats
+
+# each job writes its tables, shapefile and result folders to batch/<job name>
+JOBS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'batch')
+
+
+def read_jobs(jobs_file):
+    """
+    Settings of every job in jobs_file, a config file with one section per job. Keys in the [DEFAULT] section are
+    shared by all jobs, like the geodatabase and the rasters, and each section sets what differs, like shapefile and
+    output_file_name
+    :return: list of (job name, settings)
+    """
+    config = configparser.ConfigParser()
+    if not config.read(jobs_file):
+        raise IOError("jobs file {} not found".format(jobs_file))
+
+    return [(name, zonal_stats.parse_settings(config[name])) for name in config.sections()]
+
+
+def job_size(settings):
+    """
+    Bytes of the job's shapefile, so the largest jobs start first and the pool is not left waiting on one at the end
+    """
+    path = os.path.splitext(settings['shapefile'])[0] + '.shp'
+
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+
+def run_job(name, settings, jobs_dir=JOBS_DIR, run_mode='fresh'):
+    """
+    Run one job into jobs_dir/name. A failed job is logged and returned, the other jobs go on
+    :return: (name, None) or (name, traceback of the error)
+    """
+    start = datetime.datetime.now()
+    logging.info("job {} starting".format(name))
+
+    try:
+        zonal_stats.run(settings, run_mode, os.path.join(jobs_dir, name))
+    except Exception:
+        error = traceback.format_exc()
+        logging.error("job {} failed\n{}".format(name, error))
+        return name, error
+
+    logging.info("job {} done in {}".format(name, datetime.datetime.now() - start))
+
+    return name, None
+
+
+def run_jobs(jobs, jobs_dir=JOBS_DIR, job_workers=1, run_mode='fresh'):
+    """
+    Run every job, job_workers at a time. Each process runs its jobs one after the other, so later jobs find the
+    modules imported, the rasters open and the remap lookups built, and all of them share the aoi and tile caches.
+    Set workers in the jobs' settings to also split each job's features across processes
+    :param jobs: list of (job name, settings), see read_jobs
+    :return: {job name: None or the traceback of its error}
+    """
+    jobs = sorted(jobs, key=lambda job: job_size(job[1]), reverse=True)
+
+    if job_workers <= 1:
+        return dict(run_job(name, settings, jobs_dir, run_mode) for name, settings in jobs)
+
+    with ProcessPoolExecutor(max_workers=job_workers) as executor:
+        futures = [executor.submit(run_job, name, settings, jobs_dir, run_mode) for name, settings in jobs]
+
+        return dict(future.result() for future in futures)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="zonal stats for many shapefiles against the same rasters")
+    parser.add_argument('jobs_file', help="config file with a [DEFAULT] section and one section per job")
+    parser.add_argument('--job-workers', type=int, default=1, help="number of jobs run side by side")
+    parser.add_argument('--jobs-dir', default=JOBS_DIR, help="folder of the jobs' result folders")
+    parser.add_argument('--resume', action='store_true',
+                        help="skip features already done with the same inputs in the previous run of each job")
+    parser.add_argument('--incremental', action='store_true',
+                        help="like --resume, and also rerun features whose geometry changed in the shapefile")
+    args = parser.parse_args()
+
+    run_mode = 'incremental' if args.incremental else 'resume' if args.resume else 'fresh'
+
+    jobs = read_jobs(args.jobs_file)
+    zonal_stats.setup_logging(jobs[0][1]['log_file'] if jobs else None)
+
+    errors = run_jobs(jobs, args.jobs_dir, args.job_workers, run_mode)
+    failed = [name for name, error in errors.items() if error]
+
+    logging.info("{} of {} jobs done{}".format(len(jobs) - len(failed), len(jobs),
+                                               ", failed: {}".format(", ".join(failed)) if failed else ""))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+"""
+Runs the pipeline (zonal_stats.run with backend = gdal) on synthetic Hansen-like GeoTIFFs and a shapefile of random
+polygons, without arcpy or the real data, and reads the time of each stage from the run report, so changes to the
+engine, the result store and the join can be compared run to run.
+
+    python -m benchmarks.run_benchmarks --size 4096 --features 2000
+    python -m benchmarks.run_benchmarks --result-backend parquet --workers 4 --compare
+"""
+import os
+import sys
+import glob
+import json
+import time
+import shutil
+import argparse
+import datetime
+import tempfile
+import contextlib
+import subprocess
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import zonal_stats
+from benchmarks import synthetic
+from utilities import instrumentation
+
+# analyses of a run: forest_loss and emissions share the loss zone, biomass_weight has its own
+ANALYSES = 'forest_loss, emissions, biomass_weight'
+
+
+def results_dir():
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+
+def git_commit():
+    try:
+        out = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                      cwd=os.path.dirname(os.path.abspath(__file__)))
+        return out.decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_settings(work_dir, tile_size, result_backend, tcd_categorized, output_format, workers, coverage):
+    """
+    Settings of a run over the synthetic rasters in work_dir/rasters and work_dir/aoi.shp, as parse_settings
+    reads them from a config file. The aoi and tile caches are off so every run reads and sums the rasters
+    """
+    return zonal_stats.parse_settings({
+        'log_file': os.path.join(work_dir, 'bench.log'), 'analysis': ANALYSES,
+        'shapefile': os.path.join(work_dir, 'aoi.shp'), 'threshold': 'all', 'tcd_categorized': tcd_categorized,
+        'geodatabase': os.path.join(work_dir, 'rasters'), 'area': 'area', 'forest': 'tcd', 'biomass': 'biomass',
+        'loss': 'loss', 'tcd': 'tcd', 'database_name': 'bench.db', 'intersect': '', 'intersect_col': '',
+        'user_def_column_name': 'name', 'output_file_name': 'output', 'backend': 'gdal',
+        'raster_functions': 'numpy', 'engine': 'numpy', 'coverage': coverage, 'tile_size': str(tile_size),
+        'workers': str(workers), 'result_backend': result_backend, 'output_format': output_format,
+        'aoi_cache_mb': '0', 'tile_cache_mb': '0'})
+
+
+def run(size, features, radius, tile_size, result_backend, tcd_categorized, output_format, workers, coverage, seed):
+    """
+    Run the pipeline once on a size x size grid
+    :return: dict of the run parameters and, per stage of the run report, seconds, features/sec and megapixels/sec
+    """
+    work_dir = tempfile.mkdtemp(prefix='zstats_bench_')
+
+    try:
+        os.makedirs(os.path.join(work_dir, 'rasters'))
+        synthetic.write_rasters(synthetic.make_rasters(size, size, seed=seed), os.path.join(work_dir, 'rasters'))
+        synthetic.write_aois(synthetic.make_aois(features, size, size, radius=radius, seed=seed),
+                             os.path.join(work_dir, 'aoi.shp'))
+
+        settings = bench_settings(work_dir, tile_size, result_backend, tcd_categorized, output_format, workers,
+                                  coverage)
+        job_dir = os.path.join(work_dir, 'job')
+
+        # the pipeline prints a line per chunk and analysis
+        start = time.perf_counter()
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            layer = zonal_stats.run(settings, job_dir=job_dir)
+        wall_seconds = time.perf_counter() - start
+
+        with open(instrumentation.report_path(job_dir, settings['output_file_name']) + '.json') as f:
+            run_report = json.load(f)
+
+        result_rows = sum(len(getattr(layer, x)) for x in ['forest_loss', 'emissions', 'biomass_weight'])
+        final_output = os.path.join(job_dir, 'result', '{}.{}'.format(settings['output_file_name'], output_format))
+        output_mb = os.path.getsize(final_output) / 1024.0 / 1024.0
+
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    # the stages of the worker processes are summed over the workers
+    stages = {}
+    for name, stats in run_report['stages'].items():
+        seconds = stats['total_seconds']
+        stages[name] = {'seconds': seconds, 'features_per_sec': features / seconds if seconds else None,
+                        'megapixels_per_sec': size * size / 1e6 / seconds if seconds else None}
+
+    return {'params': {'size': size, 'features': features, 'radius': radius, 'tile_size': tile_size,
+                       'result_backend': result_backend, 'tcd_categorized': tcd_categorized,
+                       'output_format': output_format, 'workers': workers, 'coverage': coverage, 'seed': seed},
+            'git_commit': git_commit(), 'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+            'result_rows': int(result_rows), 'output_mb': output_mb, 'total_seconds': wall_seconds,
+            'counters': run_report['counters'], 'stages': stages}
+
+
+def previous_result(params):
+    """
+    The latest saved result run with the same parameters, or None
+    """
+    for path in sorted(glob.glob(os.path.join(results_dir(), '*.json')), reverse=True):
+        with open(path) as f:
+            result = json.load(f)
+        if result['params'] == params:
+            return result
+
+    return None
+
+
+def save_result(result):
+    if not os.path.exists(results_dir()):
+        os.makedirs(results_dir())
+
+    out_file = os.path.join(results_dir(), '{}_{}.json'.format(
+        result['timestamp'].replace(':', '').replace('-', ''), result['git_commit'] or 'nogit'))
+    with open(out_file, 'w') as f:
+        json.dump(result, f, indent=2)
+
+    return out_file
+
+
+def print_result(result, previous=None):
+    print("{} x {} pixels, {} features, {} result rows".format(result['params']['size'], result['params']['size'],
+                                                             result['params']['features'], result['result_rows']))
+    print("{:<14}{:>10}{:>14}{:>14}{:>12}".format('stage', 'seconds', 'features/s', 'Mpixels/s', 'vs prev'))
+
+    for name, stats in result['stages'].items():
+        change = ''
+        if previous is not None and name in previous['stages'] and previous['stages'][name]['seconds']:
+            change = '{:+.0f} %'.format((stats['seconds'] / previous['stages'][name]['seconds'] - 1) * 100)
+
+        print("{:<14}{:>10.3f}{:>14.0f}{:>14.1f}{:>12}".format(name, stats['seconds'], stats['features_per_sec'] or 0,
+                                                                stats['megapixels_per_sec'] or 0, change))
+
+    # the stages overlap (see queue_depth) and run in every worker, the total is the time the run took
+    print("{:<14}{:>10.3f}".format('total', result['total_seconds']))
+    if previous is not None:
+        print("compared with {} run at {}".format(previous['git_commit'], previous['timestamp']))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='benchmark the zonal stats pipeline on synthetic data')
+    parser.add_argument('--size', type=int, default=4096, help='rows and columns of the synthetic rasters')
+    parser.add_argument('--features', type=int, default=2000, help='number of synthetic aoi polygons')
+    parser.add_argument('--radius', type=int, default=40, help='mean polygon radius in pixels')
+    parser.add_argument('--tile-size', type=int, default=1024, help='window size of the numpy engine')
+    parser.add_argument('--result-backend', default='sqlite', choices=['sqlite', 'parquet'])
+    parser.add_argument('--tcd-categorized', default='yes', choices=['yes', 'no'])
+    parser.add_argument('--output-format', default='csv', choices=['csv', 'parquet'])
+    parser.add_argument('--workers', type=int, default=1, help='worker processes of the run')
+    parser.add_argument('--coverage', default='center', choices=['center', 'exact'])
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--compare', action='store_true',
+                        help='show the change from the last saved run with the same parameters')
+    parser.add_argument('--no-save', action='store_true', help='do not save the result to benchmarks/results')
+    args = parser.parse_args(argv)
+
+    result = run(args.size, args.features, args.radius, args.tile_size, args.result_backend, args.tcd_categorized,
+                 args.output_format, args.workers, args.coverage, args.seed)
+
+    previous = previous_result(result['params']) if args.compare else None
+    print_result(result, previous)
+
+    if not args.no_save:
+        print("saved {}".format(save_result(result)))
+
+
+if __name__ == '__main__':
+    main()
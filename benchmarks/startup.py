@@ -0,0 +1,66 @@
+"""
+Checks that the entry points start fast: importing zonal_stats and batch, as the worker processes do, must stay
+under a time budget and must not import the heavy modules, which are only imported once a run starts.
+
+    python -m benchmarks.startup
+    python -m benchmarks.startup --budget 0.5 --repeat 10
+"""
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# modules that take most of the startup time, or need ArcGIS/GDAL
+HEAVY_MODULES = ['arcpy', 'geopandas', 'pandas', 'numpy', 'rasterio', 'shapely', 'pyarrow']
+
+# imports module in a fresh interpreter and prints the seconds it took and the heavy modules it imported
+CHILD = """
+import sys, time, json
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+print(json.dumps({{'seconds': seconds, 'heavy': [x for x in {heavy!r} if x in sys.modules]}}))
+"""
+
+
+def import_time(module, repeat=5):
+    """
+    Best of repeat imports of module, each in a new interpreter so nothing is imported already
+    :return: seconds, list of the heavy modules imported with it
+    """
+    results = []
+    for _ in range(repeat):
+        out = subprocess.check_output([sys.executable, '-c', CHILD.format(module=module, heavy=HEAVY_MODULES)],
+                                      cwd=REPO_DIR)
+        results.append(json.loads(out.decode('utf-8').strip().splitlines()[-1]))
+
+    return min(x['seconds'] for x in results), results[0]['heavy']
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='check the import time of the entry points')
+    parser.add_argument('--budget', type=float, default=0.25, help='most seconds an import may take')
+    parser.add_argument('--repeat', type=int, default=5, help='imports per module, the fastest is kept')
+    parser.add_argument('--modules', default='zonal_stats,batch', help='comma separated modules to check')
+    args = parser.parse_args(argv)
+
+    failed = []
+    for module in [x.strip() for x in args.modules.split(',') if x.strip()]:
+        seconds, heavy = import_time(module, args.repeat)
+        ok = seconds <= args.budget and not heavy
+
+        print("{:<15} {:8.3f}s  {}{}".format(module, seconds, 'ok' if ok else 'FAILED',
+                                            '  imports {}'.format(', '.join(heavy)) if heavy else ''))
+        if not ok:
+            failed.append(module)
+
+    if failed:
+        print("over the {}s budget or importing heavy modules: {}".format(args.budget, ', '.join(failed)))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+import os
+import numpy as np
+import shapely
+
+# Hansen tiles are 0.00025 degrees, about 30 m at the equator
+CELLSIZE = 0.00025
+
+# remap_gtall.rft.xml: tcd ranges [min, max) and the code each range is remapped to
+TCD_EDGES = [2, 11, 16, 21, 26, 31, 51, 76, 101]
+TCD_CODES = [40, 80, 120, 160, 200, 240, 280, 320]
+
+
+def make_rasters(nrows, ncols, seed=0, top=0.0, left=0.0, loss_rate=0.05, last_year=23):
+    """
+    Hansen-like rasters on one grid
+    :return: dict of arrays: tcd (0-100), loss (0 no loss, 1-last_year = 2001...), area (m2 per pixel, shrinking with
+    latitude) and biomass (Mg/ha, following tcd)
+    """
+    rng = np.random.default_rng(seed)
+
+    # smooth-ish tree cover: blocky noise so features see a realistic mix of bins
+    coarse = rng.integers(0, 101, (nrows // 16 + 1, ncols // 16 + 1))
+    tcd = np.kron(coarse, np.ones((16, 16), dtype=coarse.dtype))[:nrows, :ncols]
+    tcd = np.clip(tcd + rng.integers(-5, 6, (nrows, ncols)), 0, 100).astype(np.uint8)
+
+    loss = np.where(rng.random((nrows, ncols)) < loss_rate * tcd / 100.0,
+                    rng.integers(1, last_year + 1, (nrows, ncols)), 0).astype(np.uint8)
+
+    lat = top - (np.arange(nrows) + 0.5) * CELLSIZE
+    pixel_m = CELLSIZE * 111320.0
+    area = np.repeat((pixel_m * pixel_m * np.cos(np.radians(lat)))[:, None], ncols, axis=1).astype(np.float32)
+
+    biomass = (tcd * rng.uniform(1.5, 3.0, (nrows, ncols))).astype(np.float32)
+
+    return {'tcd': tcd, 'loss': loss, 'area': area, 'biomass': biomass}
+
+
+def remap_tcd(tcd):
+    """
+    tcd remapped like remap_gtall.rft.xml, values outside the ranges are left as they are
+    """
+    bins = np.digitize(tcd, TCD_EDGES)
+    inside = (bins > 0) & (bins < len(TCD_EDGES))
+    codes = np.array([0] + TCD_CODES + [0])
+
+    return np.where(inside, codes[bins], tcd).astype(np.int32)
+
+
+def zone_codes(rasters, tcd_categorized='yes'):
+    """
+    The loss mosaic with the arithmetic function applied: loss + remapped tcd, or loss + (tcd + 1) * 40 when
+    tcd_categorized = no
+    """
+    if tcd_categorized == 'yes':
+        return rasters['loss'].astype(np.int32) + remap_tcd(rasters['tcd'])
+
+    return rasters['loss'].astype(np.int32) + (rasters['tcd'].astype(np.int32) + 1) * 40
+
+
+def biomass_per_pixel(rasters):
+    """
+    The biomass mosaic with the arithmetic functions applied: biomass x area / 10000, Mg per pixel
+    """
+    return rasters['biomass'] * rasters['area'] / 10000
+
+
+def make_aois(count, nrows, ncols, radius=40, vertices=12, seed=0, top=0.0, left=0.0):
+    """
+    Random star shaped polygons in the raster's coordinates
+    :param radius: mean radius in pixels
+    :return: list of shapely polygons, the list index is the FID
+    """
+    rng = np.random.default_rng(seed)
+    angles = np.linspace(0, 2 * np.pi, vertices, endpoint=False)
+    polygons = []
+
+    for _ in range(count):
+        cx = left + rng.uniform(radius, ncols - radius) * CELLSIZE
+        cy = top - rng.uniform(radius, nrows - radius) * CELLSIZE
+        r = radius * CELLSIZE * rng.uniform(0.5, 1.5) * rng.uniform(0.6, 1.0, vertices)
+        polygons.append(shapely.Polygon(np.column_stack([cx + r * np.cos(angles), cy + r * np.sin(angles)])))
+
+    return polygons
+
+
+def write_rasters(rasters, folder, top=0.0, left=0.0):
+    """
+    Write the rasters of make_rasters as tiled GeoTIFFs in EPSG:4326, <name>.tif in folder, the plain rasters a
+    run with backend = gdal and raster_functions = numpy reads
+    """
+    import rasterio
+    from rasterio.transform import Affine
+
+    transform = Affine(CELLSIZE, 0.0, left, 0.0, -CELLSIZE, top)
+
+    for name, array in rasters.items():
+        nrows, ncols = array.shape
+        with rasterio.open(os.path.join(folder, '{}.tif'.format(name)), 'w', driver='GTiff', height=nrows,
+                           width=ncols, count=1, dtype=array.dtype, crs='EPSG:4326', transform=transform, tiled=True,
+                           blockxsize=256, blockysize=256) as dst:
+            dst.write(array, 1)
+
+
+def write_aois(polygons, path):
+    """
+    Write the polygons of make_aois to a shapefile in EPSG:4326, with a name column
+    """
+    import geopandas as gpd
+
+    names = ['aoi {}'.format(i) for i in range(len(polygons))]
+    gpd.GeoDataFrame({'name': names}, geometry=polygons, crs='EPSG:4326').to_file(path)
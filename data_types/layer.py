@@ -1,11 +1,11 @@
 import os
-import pandas as pd
-import arcpy
-import sys
 import logging
 
+from utilities import aoi_reader
+from utilities import spatial_index
 from utilities import zstats_handler
 from utilities import post_processing
+from utilities import workspace
 
 
 class Layer(object):
@@ -27,18 +27,30 @@ class Layer(object):
         self.biomass_weight = None
         self.forest_extent = None
 
-        self.root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        # the repository folder, or the folder of the job in a batch run
+        self.root_dir = workspace.job_dir()
+
+        # everything is projected to WGS84 into the shapefile folder
+        self.out_cs = 4326
+        self.projected_aoi = os.path.join(workspace.folder('shapefile'), "project.shp")
 
         print("creating Layer with aoi {} and source id column {}\n".format(self.source_aoi, self.source_id_col))
 
     # these are all the things i want to do with the input shapefile. this is called from zonal_stats.py
-    def project_source_aoi(self):
-        arcpy.env.overwriteOutput = True
-        out_cs = arcpy.SpatialReference(4326)
-        self.final_aoi = os.path.join(self.root_dir, 'shapefile', "project.shp")
-        arcpy.Project_management(self.source_aoi, self.final_aoi, out_cs)
-
-    def join_tables(self, tcd_categorized, threshold, user_def_column_name, output_file_name):
+    def project_source_aoi(self, backend):
+        self.final_aoi = self.projected_aoi
+        backend.project(self.source_aoi, self.final_aoi, self.out_cs)
+
+    def join_tables(self, tcd_categorized, threshold, user_def_column_name, output_file_name, output_format='csv',
+                    chunk_features=10000, aoi_df=None):
+        """
+        Join the analysis tables, decode VALUE to tcd and loss year and write the result. Rows are filtered and
+        decoded before the join, only the aoi columns in user_def_column_name (and intersect_col) are joined, by
+        integer ID, and the output is written chunk_features features at a time, so memory grows with the size of
+        a chunk and not with features x codes x attributes
+        :param output_format: csv or parquet
+        :param aoi_df: columns to join indexed by ID, instead of the aoi columns. See feature_groups
+        """
         print("joining tables \n")
 
         # make a list of all the tables we have. These are already dataframes
@@ -47,82 +59,65 @@ class Layer(object):
         # get rid of df's we don't have
         df_list = [x for x in possible_dfs if x is not None]
 
-        # how to get column names to keep? like extent, emissions, loss? i'm going through and getting
-        # second column for each df which is the analysis name
-        print(df_list)
-        analysis_names = [x.columns.values[2] for x in df_list]
-        logging.info("Analysis names required: {}".format(analysis_names))
-
-        # convert original SUM values into the right units
-        for index, item in enumerate(analysis_names):
-
-            if item == 'forest_loss':
-                analysis_names[index] = 'forest_loss_ha'
-
-                self.forest_loss['forest_loss'] = self.forest_loss.forest_loss.astype(float)
-                self.forest_loss['forest_loss_ha'] = self.forest_loss['forest_loss'] / 10000
-
-            if item == 'forest_extent':
-                analysis_names[index] = 'forest_extent_ha'
-
-                self.forest_extent['forest_extent'] = self.forest_extent.forest_extent.astype(float)
-                self.forest_extent['forest_extent_ha'] = self.forest_extent['forest_extent'] / 10000
-
-            if item == 'biomass_weight':
-                analysis_names[index] = 'biomass_weight_Tg'
-
-                self.biomass_weight['biomass_weight'] = self.biomass_weight.biomass_weight.astype(float)
-                self.biomass_weight['biomass_weight_Tg'] = self.biomass_weight['biomass_weight'] / 1000000
-
-        # join all the data frames together on Value and ID. Value is the tcd/loss code (41 = loss in 2001 at 1-10%tcd
-        # or loss in 2001 at >30% tcd. ID is the unique ID of the feature in the shapefile
-        merged = pd.concat([df.set_index(['VALUE', 'ID']) for df in df_list], axis=1)
-        merged = merged.reset_index()
-
-        # To 2 get outputs from a single function and apply to 2 different columns in the dataframe:
-        # http://stackoverflow.com/questions/12356501/pandas-create-two-new-columns-in-a-dataframe-with-
-        # values-calculated-from-a-pre?rq=1
-        # tcd and year columns is equal to the first and second output from the function: value_to_tcd_year
-
-        if tcd_categorized == "yes":
-            try:
-                merged['tcd'], merged['year'] = list(zip(*merged["VALUE"].map(post_processing.value_to_tcd_year)))
-            except KeyError:
-                logging.info("oops, loss mosaic doesn't have the arithmetic function applied. Refer to readme file")
-        else:
-            try:
-                merged['tcd'], merged['year'] = list(zip(*merged["VALUE"].map(post_processing.value_to_tcd_year_each)))
-            except KeyError:
-                logging.info("oops, loss mosaic doesn't have the arithmetic function applied. Refer to readme file")
-
-        # the value_to_tcd_year function is good for when user runs all thresholds, but not just one.
-        # so, overwrite the tcd column when it comes back
-        if threshold != "all" and tcd_categorized == "yes":
-            merged['tcd'] = "> {}%".format(threshold)
-
-        # convert shp to pandas dataframe
-        final_aoi_df = zstats_handler.gdf2pd(self.final_aoi)
-
-        # reset index of final_aoi_df
-        final_aoi_df = final_aoi_df.reset_index()
-
-        merged = pd.merge(merged, final_aoi_df, left_on='ID', right_on='index')
-        merged = merged[merged['year'] > 2000]
-        
-        # get rid of undesired columns here
-        if "ID" in merged.columns:
-            del merged['ID']
-        if "index" in merged.columns:
-            del merged['index']
-        if "ha" in merged.columns:
-            del merged['ha']
-        if "forest_loss" in merged.columns:
-            del merged['forest_loss']
-        if "forest_extent" in merged.columns:
-            del merged['forest_extent']
-
-        print('SAMPLE OF OUTPUT:')
-        print(merged.head(5))
-
-        final_output_csv = os.path.join(self.root_dir, 'result', '{}.csv'.format(output_file_name))
-        merged.to_csv(final_output_csv, index=False)
+        # convert original SUM values into the right units (ha, Tg), one vectorized column each. emissions are in
+        # MtCO2 already. The third column of each df is the analysis name
+        df_list = [post_processing.to_units(df) for df in df_list]
+        logging.info("Analysis names required: {}".format([x.columns.values[2] for x in df_list]))
+
+        # filter to loss rows and sort by ID so each chunk of features is a slice
+        tables = [post_processing.loss_rows(df, tcd_categorized) for df in df_list]
+
+        # only the aoi columns asked for, indexed by FID which is the ID of the results
+        if aoi_df is None:
+            aoi_df = self.aoi_attributes(user_def_column_name)
+
+        final_output = os.path.join(workspace.folder('result'), '{}.{}'.format(output_file_name, output_format))
+        post_processing.write_joined(tables, aoi_df, tcd_categorized, threshold, final_output, output_format,
+                                     chunk_features)
+
+    def aoi_attributes(self, user_def_column_name):
+        """
+        Read only the columns of the final aoi that go in the output: user_def_column_name (comma separated) and
+        intersect_col when the aoi was intersected. Returns None if there are none, the output then keeps ID
+        """
+        columns = [x.strip() for x in user_def_column_name.split(',') if x.strip()]
+        if isinstance(self.source_id_col, list):
+            columns += [x for x in self.source_id_col if x not in columns]
+
+        available = aoi_reader.column_names(self.final_aoi)
+        missing = [x for x in columns if x not in available]
+        if missing:
+            logging.info("columns {} are not in {}".format(missing, self.final_aoi))
+
+        columns = [x for x in columns if x in available]
+        if not columns:
+            return None
+
+        # the row position in the shapefile is the FID
+        return zstats_handler.gdf2pd(self.final_aoi, columns=columns).reset_index(drop=True)
+
+    def feature_groups(self, columns):
+        """
+        Group the features of the final aoi on the values of columns, like a dissolve on them would
+        :param columns: list of column names
+        :return: int array of the group of each FID (-1 where a column is empty) and the columns of each group indexed
+        by group, to join to the results of zonal_engine.group_table
+        """
+        df = zstats_handler.gdf2pd(self.final_aoi, columns=columns).reset_index(drop=True)
+
+        groups = df.groupby(columns, sort=True).ngroup().values
+        group_df = df[groups >= 0].assign(ID=groups[groups >= 0]).drop_duplicates('ID').set_index('ID').sort_index()
+
+        logging.info("{} features in {} groups of {}".format(len(df), len(group_df), columns))
+
+        return groups.astype(int), group_df[columns]
+
+    def overlapping_groups(self, columns):
+        """
+        The groups of columns (see feature_groups) in which features of the final aoi overlap each other
+        :return: the columns of those groups, indexed by group
+        """
+        feature_groups, group_df = self.feature_groups(columns)
+        geometry = aoi_reader.read_features(self.final_aoi, columns=[]).geometry.values
+
+        return group_df.loc[spatial_index.overlapping_groups(geometry, feature_groups)]
@@ -1,16 +1,20 @@
 import os
-import pandas as pd
-import sqlite3
 import logging
 
+from raster_functions import raster_algebra
+from utilities import post_processing, result_store
+
 class Raster(object):
     """ A layer class to prep the input shapefile to zonal stats
     :param source_aoi: the path to the shapefile to run zonal stats
     :param source_id_col: the unique ID field in the input shapefile
+    :param raster_functions: mosaic if the Remap and Arithmetic functions are applied to the mosaics, numpy to
+    apply them window by window to plain loss, tcd, area and biomass rasters
     :return:
     """
 
-    def __init__(self, analysis, geodatabase, area, forest, loss, tcd, biomass):
+    def __init__(self, analysis, geodatabase, area, forest, loss, tcd, biomass, raster_functions='mosaic',
+                 threshold='all', tcd_categorized='yes'):
         logging.info("\ncreating a raster object for analysis {}".format(analysis))
         self.analysis = analysis
         self.zone = None
@@ -24,6 +28,9 @@ class Raster(object):
         self.loss = loss
         self.tcd = tcd
         self.biomass = biomass
+        self.raster_functions = raster_functions
+        self.threshold = threshold
+        self.tcd_categorized = tcd_categorized
 
         self.populate_ras_prop()
 
@@ -37,21 +44,51 @@ class Raster(object):
         self.value = os.path.join(self.geodatabase, zone_value_dict[self.analysis]["value"])
         self.cellsize = zone_value_dict[self.analysis]['cellsize']
 
-        logging.info("populating raster properties with zone: {} and value: {} and cell size {}".format(os.path.basename(self.zone),
-                                                                                os.path.basename(self.value),
+        if self.raster_functions == 'numpy':
+            self.apply_raster_functions()
+
+        logging.info("populating raster properties with zone: {} and value: {} and cell size {}".format(self.zone,
+                                                                                                 self.value,
                                                                                                  self.cellsize))
 
-    def db_to_df(self, l, database_name):
+    def apply_raster_functions(self):
+        """
+        Replace the zone and value mosaics with expressions computed window by window: loss + remapped tcd for
+        the loss zone, remapped tcd for biomass_weight and biomass x area / 10000 for the biomass value
+        """
+        loss, tcd, area, biomass = [os.path.join(self.geodatabase, x) for x in
+                                    [self.loss, self.tcd, self.area, self.biomass]]
+
+        if self.analysis in ['forest_loss', 'emissions']:
+            self.zone = raster_algebra.loss_tcd(loss, tcd, self.threshold, self.tcd_categorized)
+        if self.analysis == 'biomass_weight':
+            self.zone = raster_algebra.tcd_codes(tcd, self.threshold, self.tcd_categorized)
+        if self.analysis in ['biomass_weight', 'emissions']:
+            self.value = raster_algebra.biomass_per_pixel(biomass, area)
 
-        # convert sql table to df
-        print("converting sql table to df")
-        tables_dir = os.path.join(l.root_dir, 'tables')
-        zstats_results_db = os.path.join(tables_dir, database_name)
+    def db_to_df(self, l, database_name, result_backend='sqlite'):
 
-        conn = sqlite3.connect(zstats_results_db)
-        # self.analysis is like: forest_loss and/or emissions, etc
-        qry = "SELECT VALUE, ID, {0} FROM {0} WHERE VALUE > 0".format(self.analysis)
-        df = pd.read_sql(qry, conn)
+        # convert the results table to df
+        print("converting results table to df")
+        store = result_store.open_store(database_name, result_backend)
+
+        # self.analysis is like: forest_loss and/or emissions, etc. Kept as uint16 VALUE, uint32 ID and float64 sums
+        df = post_processing.compact(store.read(self.analysis))
+        store.close()
 
         logging.info(df)
-        self.df = df
\ No newline at end of file
+        self.df = df
+
+
+def group_by_zone(rasters):
+    """
+    Group Raster objects that share a zone raster, in the order they were requested. forest_loss and emissions
+    both use loss as the zone, so they can be summed from one read of it
+    :param rasters: list of Raster objects
+    :return: list of lists of Raster objects
+    """
+    groups = {}
+    for raster in rasters:
+        groups.setdefault(raster.zone, []).append(raster)
+
+    return list(groups.values())
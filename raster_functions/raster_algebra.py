@@ -0,0 +1,268 @@
+import os
+import numpy as np
+import xml.etree.ElementTree as ET
+
+# the rft.xml templates sit next to this file
+RFT_DIR = os.path.dirname(os.path.abspath(__file__))
+XSI_TYPE = '{http://www.w3.org/2001/XMLSchema-instance}type'
+
+# arguments parsed from each remap template and lookup tables of each remap by input dtype, built once per process
+# and kept across chunks and runs
+_rft_arguments = {}
+_lookups = {}
+
+
+class Expression(object):
+    """ A raster computed window by window from source rasters, like a mosaic with raster functions applied but
+    without editing the mosaic or writing intermediate rasters. Two expressions are equal if they describe the same
+    computation, so analyses sharing a zone expression are still grouped together
+    :return:
+    """
+
+    def sources(self):
+        return []
+
+    def evaluate(self, read):
+        """
+        Compute the window, read(path) returns the window of the source raster at path
+        """
+        raise NotImplementedError
+
+    def __eq__(self, other):
+        return isinstance(other, Expression) and repr(self) == repr(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(repr(self))
+
+
+class Source(Expression):
+    def __init__(self, path):
+        self.path = path
+
+    def sources(self):
+        return [self.path]
+
+    def evaluate(self, read):
+        return read(self.path)
+
+    def __repr__(self):
+        return self.path
+
+
+class Constant(Expression):
+    def __init__(self, value):
+        self.value = value
+
+    def evaluate(self, read):
+        return self.value
+
+    def __repr__(self):
+        return repr(self.value)
+
+
+class BinaryOp(Expression):
+    """ Cell by cell operation of two expressions. Integer rasters are computed as at least int32, so loss + tcd
+    codes up to 4079 do not wrap around in uint8
+    :return:
+    """
+
+    name = None
+
+    def __init__(self, left, right):
+        self.left = as_expression(left)
+        self.right = as_expression(right)
+
+    def sources(self):
+        return self.left.sources() + self.right.sources()
+
+    def evaluate(self, read):
+        left = self.left.evaluate(read)
+        right = self.right.evaluate(read)
+
+        dtype = np.result_type(left, right)
+        if dtype.kind in 'biu':
+            dtype = np.promote_types(dtype, np.int32)
+
+        return self.apply(left, right, dtype)
+
+    def __repr__(self):
+        return '{}({!r}, {!r})'.format(self.name, self.left, self.right)
+
+
+class Add(BinaryOp):
+    name = 'add'
+
+    def apply(self, left, right, dtype):
+        return np.add(left, right, dtype=dtype)
+
+
+class Multiply(BinaryOp):
+    name = 'multiply'
+
+    def apply(self, left, right, dtype):
+        return np.multiply(left, right, dtype=dtype)
+
+
+class Divide(BinaryOp):
+    name = 'divide'
+
+    def apply(self, left, right, dtype):
+        return np.true_divide(left, right, dtype=np.promote_types(dtype, np.float32))
+
+
+class Remap(Expression):
+    """ Remap function: values in [min, max) of each input range become the output value of that range
+    :param raster: expression to remap
+    :param input_ranges: list of (min, max)
+    :param output_values: one value per range
+    :param allow_unmatched: keep values outside every range, otherwise they become 0 (no data)
+    :return:
+    """
+
+    def __init__(self, raster, input_ranges, output_values, allow_unmatched=True, name='remap'):
+        self.raster = as_expression(raster)
+        self.input_ranges = [tuple(x) for x in input_ranges]
+        self.output_values = list(output_values)
+        self.allow_unmatched = allow_unmatched
+        self.name = name
+
+    @classmethod
+    def from_rft(cls, rft_file, raster):
+        """
+        Remap built from the InputRanges, OutputValues and AllowUnmatched of a remap .rft.xml template
+        """
+        if rft_file not in _rft_arguments:
+            _rft_arguments[rft_file] = read_rft(rft_file)
+        arguments = _rft_arguments[rft_file]
+
+        ranges = arguments['InputRanges']
+        input_ranges = list(zip(ranges[0::2], ranges[1::2]))
+        output_values = [int(x) if x == int(x) else x for x in arguments['OutputValues']]
+        allow_unmatched = arguments.get('AllowUnmatched', 'true') == 'true'
+        name = os.path.basename(rft_file).split('.')[0]
+
+        return cls(raster, input_ranges, output_values, allow_unmatched, name)
+
+    def sources(self):
+        return self.raster.sources()
+
+    def evaluate(self, read):
+        values = self.raster.evaluate(read)
+        integer = all(float(x) == int(x) for x in self.output_values)
+        out_dtype = np.dtype(np.int32 if integer and values.dtype.kind in 'biu' else np.float64)
+
+        # small integer rasters like tcd go through a lookup table, one fancy index for the whole window
+        if values.dtype.kind in 'bu' and values.dtype.itemsize <= 2:
+            key = (repr(self), values.dtype.str)
+            if key not in _lookups:
+                _lookups[key] = self.remap(np.arange(2 ** (8 * values.dtype.itemsize)), out_dtype)
+            return _lookups[key][values]
+
+        return self.remap(values, out_dtype)
+
+    def remap(self, values, out_dtype):
+        out = values.astype(out_dtype) if self.allow_unmatched else np.zeros(values.shape, out_dtype)
+
+        for (lo, hi), output in zip(self.input_ranges, self.output_values):
+            out[(values >= lo) & (values < hi)] = output
+
+        return out
+
+    def __repr__(self):
+        return '{}({!r}, {}, {}, {})'.format(self.name, self.raster, self.input_ranges, self.output_values,
+                                             self.allow_unmatched)
+
+
+def read_rft(rft_file):
+    """
+    The arguments of a raster function template, {name: value}, arrays of doubles as lists of floats
+    """
+    arguments = {}
+    for variable in ET.parse(rft_file).getroot().iter('AnyType'):
+        name = variable.findtext('Name', '').split('_')[0]
+        value = variable.find('Value')
+        if value is None:
+            continue
+
+        if value.get(XSI_TYPE) == 'typens:ArrayOfDouble':
+            arguments[name] = [float(x.text) for x in value.findall('Double')]
+        else:
+            arguments[name] = value.text
+
+    return arguments
+
+
+def as_expression(raster):
+    """
+    raster as an Expression: paths become Source, numbers Constant
+    """
+    if isinstance(raster, Expression):
+        return raster
+    if isinstance(raster, (int, float)):
+        return Constant(raster)
+
+    return Source(raster)
+
+
+def sources(rasters):
+    """
+    Paths of the source rasters the expressions read, each once, in the order they are first used
+    """
+    paths = []
+    for raster in rasters:
+        for path in as_expression(raster).sources():
+            if path not in paths:
+                paths.append(path)
+
+    return paths
+
+
+def evaluate(rasters, read, window, windows=None):
+    """
+    Compute a window of every expression. Each source raster is read once per window, however many expressions
+    use it (area in forest_loss and in emissions, tcd in the zone codes)
+    :param read: read(path, window) returns the window of the raster at path
+    :param windows: dict filled with the source windows read, by path
+    """
+    windows = {} if windows is None else windows
+
+    def read_once(path):
+        if path not in windows:
+            windows[path] = read(path, window)
+        return windows[path]
+
+    return [as_expression(raster).evaluate(read_once) for raster in rasters]
+
+
+def tcd_bins(tcd, threshold):
+    """
+    tcd remapped with remap_gt<threshold>.rft.xml, like raster_prep.remap_threshold does to the tcd mosaic
+    """
+    return Remap.from_rft(os.path.join(RFT_DIR, 'remap_gt{}.rft.xml'.format(threshold)), tcd)
+
+
+def tcd_codes(tcd, threshold, tcd_categorized):
+    """
+    tcd coded in steps of 40: remapped bins, or (tcd + 1) * 40 when tcd_categorized = no
+    """
+    if tcd_categorized == 'yes':
+        return tcd_bins(tcd, threshold)
+
+    return Multiply(Add(tcd, 1), 40)
+
+
+def loss_tcd(loss, tcd, threshold, tcd_categorized):
+    """
+    The zone codes of the loss mosaic with its Arithmetic function: loss + tcd codes
+    """
+    return Add(loss, tcd_codes(tcd, threshold, tcd_categorized))
+
+
+def biomass_per_pixel(biomass, area):
+    """
+    The biomass mosaic with its Arithmetic functions: biomass (Mg/ha) x area (m2) / 10000, Mg per pixel
+    """
+    return Divide(Multiply(biomass, area), 10000)
@@ -1,9 +1,9 @@
 import os
-import arcpy
 import csv
 
 
 def remap_threshold(geodatabase, threshold):
+    import arcpy
 
     # Apply a remap function to the tcd mosaic. Turns values of TCD into bins recoded to
     # values of 40, 80, etc.
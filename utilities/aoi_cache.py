@@ -0,0 +1,139 @@
+import os
+import glob
+import uuid
+import shutil
+import hashlib
+import logging
+
+from utilities import checkpoint
+
+# files that make up a shapefile, all of them go into the key and the cache
+SHAPEFILE_EXTENSIONS = ['.shp', '.shx', '.dbf', '.prj', '.cpg']
+
+
+def cache_dir():
+    return os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'cache', 'aoi')
+
+
+def shapefile_files(shapefile):
+    stem = os.path.splitext(shapefile)[0]
+
+    return [stem + ext for ext in SHAPEFILE_EXTENSIONS if os.path.exists(stem + ext)]
+
+
+def cache_key(sources, params):
+    """
+    Hash of the content of the source shapefiles and the parameters of the overlay/projection
+    :param sources: shapefiles the aoi is built from (the shapefile and the intersect boundary). Feature classes
+    inside a geodatabase are not files, so they are keyed on their path and the geodatabase's modified time
+    :param params: dict like intersect_col and the target spatial reference
+    """
+    sha = hashlib.sha1()
+
+    for source in sources:
+        files = shapefile_files(source)
+        if not files:
+            sha.update("{}={}\n".format(source, checkpoint.path_mtime(source)).encode('utf-8'))
+
+        for path in files:
+            sha.update(os.path.basename(path).encode('utf-8'))
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(1024 * 1024), b''):
+                    sha.update(block)
+
+    for key in sorted(params):
+        sha.update("{}={}\n".format(key, params[key]).encode('utf-8'))
+
+    return sha.hexdigest()
+
+
+def lookup(key, out_shapefile):
+    """
+    Copy the cached aoi for key to out_shapefile. Entries only appear once complete (see store), and one evicted by
+    another job while it is copied is a miss
+    :return: out_shapefile, or None if key is not cached
+    """
+    entry = os.path.join(cache_dir(), key)
+    cached = glob.glob(os.path.join(entry, '*.shp'))
+
+    if not cached:
+        return None
+
+    try:
+        copy_shapefile(cached[0], out_shapefile)
+
+        # the entry's modified time is its last use, for eviction
+        os.utime(entry, None)
+    except OSError:
+        logging.info("cached aoi {} was evicted while it was read".format(entry))
+        return None
+
+    logging.info("reusing cached aoi {}".format(entry))
+
+    return out_shapefile
+
+
+def store(key, shapefile, max_size_mb):
+    """
+    Add shapefile to the cache under key, then evict the least recently used entries over max_size_mb. The entry is
+    built in a temporary folder and renamed into place, so jobs running side by side never read half an entry
+    """
+    if max_size_mb <= 0:
+        return
+
+    entry = os.path.join(cache_dir(), key)
+    if os.path.exists(entry):
+        return
+
+    tmp_entry = '{}.{}.tmp'.format(entry, uuid.uuid4().hex)
+    try:
+        os.makedirs(tmp_entry)
+        copy_shapefile(shapefile, os.path.join(tmp_entry, 'aoi.shp'))
+        os.replace(tmp_entry, entry)
+    except OSError:
+        # another job stored the same aoi first, or evicted the folder being built
+        shutil.rmtree(tmp_entry, ignore_errors=True)
+
+    evict(max_size_mb)
+
+
+def copy_shapefile(shapefile, out_shapefile):
+    out_stem = os.path.splitext(out_shapefile)[0]
+
+    for path in shapefile_files(shapefile):
+        shutil.copyfile(path, out_stem + os.path.splitext(path)[1])
+
+
+def entry_stat(entry):
+    """
+    Last use and size of a cache entry, or None if another job evicted it meanwhile
+    """
+    try:
+        return os.path.getmtime(entry), sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+    except OSError:
+        return None
+
+
+def evict(max_size_mb):
+    """
+    Delete the least recently used cache entries until the cache fits in max_size_mb. An entry is renamed away
+    before it is deleted, so a job reading it misses it instead of copying part of it, and two jobs evicting at
+    once never delete the same entry
+    """
+    stats = [(entry_stat(x), x) for x in [os.path.join(cache_dir(), x) for x in os.listdir(cache_dir())]]
+    stats = sorted((stat, entry) for stat, entry in stats if stat is not None)
+    total = sum(size for (_, size), _ in stats)
+
+    for (_, size), entry in stats:
+        if total <= max_size_mb * 1024 * 1024:
+            break
+
+        total -= size
+        evicted = '{}.{}.evicted'.format(entry, uuid.uuid4().hex)
+        try:
+            os.replace(entry, evicted)
+        except OSError:
+            continue
+
+        logging.info("evicting cached aoi {}".format(entry))
+        shutil.rmtree(evicted, ignore_errors=True)
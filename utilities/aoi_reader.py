@@ -0,0 +1,90 @@
+import os
+import importlib.util
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+# geometries are read in row ranges of this many rows, several ranges side by side
+CHUNK_ROWS = 100000
+
+# threads reading row ranges of one file, GDAL does the reading and decoding without holding the GIL
+READ_WORKERS = min(4, os.cpu_count() or 1)
+
+
+def use_arrow():
+    """
+    Read through Arrow when pyarrow is installed, the columns are then built without a Python object per value
+    """
+    return importlib.util.find_spec('pyarrow') is not None
+
+
+def feature_count(path):
+    import pyogrio
+
+    return int(pyogrio.read_info(path)['features'])
+
+
+def column_names(path):
+    """
+    The attribute columns of path, without reading any feature
+    """
+    import pyogrio
+
+    return list(pyogrio.read_info(path)['fields'])
+
+
+def row_ranges(start, stop, chunk_rows=CHUNK_ROWS):
+    return [(k, min(k + chunk_rows, stop)) for k in range(start, stop, chunk_rows)]
+
+
+def read_rows(path, start, stop, columns=None, geometry=True):
+    """
+    Rows start to stop of path, indexed by FID (the row position in the shapefile). Without geometry only columns
+    are read from the dbf and the shapes are not read at all
+    :param columns: only read these columns, all of them if None
+    """
+    import pandas as pd
+    import pyogrio
+
+    if not geometry and columns is not None and not len(columns):
+        return pd.DataFrame(index=np.arange(start, stop))
+
+    df = pyogrio.read_dataframe(path, columns=columns, read_geometry=geometry, skip_features=start,
+                                max_features=stop - start, use_arrow=use_arrow())
+    df.index = np.arange(start, start + len(df))
+
+    return df
+
+
+def read_attributes(path, columns=None):
+    """
+    The attribute table of path (a shapefile or a dbf) without its geometry, indexed by FID. Only columns are
+    decoded and the shapes are not read at all
+    :param columns: only read these columns, all of them if None
+    """
+    return read_rows(path, 0, feature_count(path), columns, geometry=False)
+
+
+def read_features(path, columns=None, rows=None, workers=READ_WORKERS, chunk_rows=CHUNK_ROWS):
+    """
+    The features of path with their geometry, as a GeoDataFrame indexed by FID. Row ranges of chunk_rows are read
+    by workers threads at once and put back in order
+    :param columns: only read these columns, [] for just the geometry, all of them if None
+    :param rows: (start, stop) of the rows to read, all of them if None
+    """
+    import pandas as pd
+    import pyogrio
+
+    start, stop = rows if rows is not None else (0, feature_count(path))
+    ranges = row_ranges(start, stop, chunk_rows)
+
+    if not ranges:
+        return pyogrio.read_dataframe(path, columns=columns, max_features=0)
+
+    if workers <= 1 or len(ranges) == 1:
+        parts = [read_rows(path, range_start, range_stop, columns) for range_start, range_stop in ranges]
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            parts = list(executor.map(lambda x: read_rows(path, x[0], x[1], columns), ranges))
+
+    return pd.concat(parts) if len(parts) > 1 else parts[0]
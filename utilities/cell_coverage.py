@@ -0,0 +1,126 @@
+import numpy as np
+import shapely
+
+
+class FeatureIndex(object):
+    """ STRtree over the features of a chunk, to find the cells of a window each feature covers and by how much.
+    Every feature gets its own cells, so where features overlap a cell counts for each of them, whatever other
+    features are in the chunk. With center coverage a feature covers the cells whose center it holds, whole. With
+    exact coverage the cells along its boundary are intersected with it and count for the fraction covered; the
+    cells the boundary does not cross are entirely inside or outside it, so they are decided by their center
+    :param shapes: list of (geometry, feature ID) in the rasters' coordinates
+    :param cellsize: (width, height) of a cell
+    :param coverage: center or exact
+    :return:
+    """
+
+    def __init__(self, shapes, cellsize, coverage='center'):
+        self.geometries = np.array([geometry for geometry, _ in shapes], dtype=object)
+        self.ids = np.array([fid for _, fid in shapes], dtype=np.int64)
+        self.tree = shapely.STRtree(self.geometries)
+        self.dx, self.dy = cellsize
+        self.exact = coverage == 'exact'
+
+        shapely.prepare(self.geometries)
+
+        # boundary vertices at most one cell apart, so every cell the boundary crosses is next to a vertex's cell
+        if self.exact:
+            self.boundary_coords = [shapely.get_coordinates(x) for x in
+                                    shapely.segmentize(shapely.boundary(self.geometries), min(self.dx, self.dy))]
+
+    def window_pairs(self, x0, y0, nrows, ncols, tile_size, grid_row=0, grid_col=0):
+        """
+        Most (cell, feature) pairs fractions can return for one window of tiling.iter_windows over the nrows x ncols
+        grid whose top left corner is x0, y0. Each feature counts the cells of its bounding box in every window the
+        box touches, at most a whole window, so this is an upper bound however the features overlap
+        """
+        bounds = shapely.bounds(self.geometries)
+        bounds = bounds[~np.isnan(bounds).any(axis=1)]
+
+        c0 = np.clip(np.floor((bounds[:, 0] - x0) / self.dx), 0, ncols).astype(np.int64)
+        c1 = np.clip(np.ceil((bounds[:, 2] - x0) / self.dx), 0, ncols).astype(np.int64)
+        r0 = np.clip(np.floor((y0 - bounds[:, 3]) / self.dy), 0, nrows).astype(np.int64)
+        r1 = np.clip(np.ceil((y0 - bounds[:, 1]) / self.dy), 0, nrows).astype(np.int64)
+        inside = (c1 > c0) & (r1 > r0)
+        c0, c1, r0, r1 = c0[inside], c1[inside], r0[inside], r1[inside]
+        if not c0.size:
+            return 0
+
+        # first and last window row and column of each box, windows are cut like iter_windows cuts them
+        row_shift, col_shift = grid_row % tile_size, grid_col % tile_size
+        w_r0, w_r1 = (r0 + row_shift) // tile_size, (r1 - 1 + row_shift) // tile_size
+        w_c0, w_c1 = (c0 + col_shift) // tile_size, (c1 - 1 + col_shift) // tile_size
+        pixels = np.minimum((r1 - r0) * (c1 - c0), tile_size * tile_size)
+
+        # add each box's pixels to the windows it touches, through a 2-d difference array over the windows
+        totals = np.zeros((w_r1.max() + 2, w_c1.max() + 2), np.int64)
+        np.add.at(totals, (w_r0, w_c0), pixels)
+        np.add.at(totals, (w_r0, w_c1 + 1), -pixels)
+        np.add.at(totals, (w_r1 + 1, w_c0), -pixels)
+        np.add.at(totals, (w_r1 + 1, w_c1 + 1), pixels)
+
+        return int(totals.cumsum(axis=0).cumsum(axis=1).max())
+
+    def fractions(self, x0, y0, nrows, ncols):
+        """
+        Fraction of each cell of the window covered by each feature, 1 for every cell a feature holds the center
+        of with center coverage
+        :param x0, y0: top left corner of the window
+        :return: cells (flat index into the window), feature ids and fractions, as 1-d arrays, one entry per
+        (cell, feature) with a fraction above 0
+        """
+        window_box = shapely.box(x0, y0 - nrows * self.dy, x0 + ncols * self.dx, y0)
+        cells, ids, fractions = [], [], []
+
+        for k in self.tree.query(window_box):
+            geometry = self.geometries[k]
+            xmin, ymin, xmax, ymax = geometry.bounds
+
+            # cells of the window under the feature's bounding box
+            c0, c1 = max(int(np.floor((xmin - x0) / self.dx)), 0), min(int(np.ceil((xmax - x0) / self.dx)), ncols)
+            r0, r1 = max(int(np.floor((y0 - ymax) / self.dy)), 0), min(int(np.ceil((y0 - ymin) / self.dy)), nrows)
+            if c1 <= c0 or r1 <= r0:
+                continue
+
+            cols = np.arange(c0, c1)
+            rows = np.arange(r0, r1)
+            xx, yy = np.meshgrid(x0 + (cols + 0.5) * self.dx, y0 - (rows + 0.5) * self.dy)
+            fraction = shapely.contains_xy(geometry, xx, yy).astype(np.float64)
+
+            if self.exact:
+                self.boundary_fractions(fraction, k, x0, y0, r0, r1, c0, c1)
+
+            hit_rows, hit_cols = np.nonzero(fraction > 0)
+            cells.append((hit_rows + r0) * ncols + hit_cols + c0)
+            ids.append(np.full(hit_rows.size, self.ids[k], np.int64))
+            fractions.append(np.minimum(fraction[hit_rows, hit_cols], 1.0))
+
+        if not cells:
+            return np.empty(0, np.int64), np.empty(0, np.int64), np.empty(0, np.float64)
+
+        return np.concatenate(cells), np.concatenate(ids), np.concatenate(fractions)
+
+    def boundary_fractions(self, fraction, k, x0, y0, r0, r1, c0, c1):
+        """
+        Replace, in fraction (the cells r0:r1, c0:c1 of the window), the cells the boundary of feature k crosses
+        by the fraction of them it covers
+        """
+        geometry = self.geometries[k]
+
+        # cells crossed by the boundary: the cells of its vertices and their neighbours
+        coords = self.boundary_coords[k]
+        vertex_cols = np.floor((coords[:, 0] - x0) / self.dx).astype(np.int64)
+        vertex_rows = np.floor((y0 - coords[:, 1]) / self.dy).astype(np.int64)
+        edge = np.zeros((r1 - r0 + 2, c1 - c0 + 2), bool)
+        for dr in (-1, 0, 1):
+            for dc in (-1, 0, 1):
+                r = vertex_rows + dr - r0 + 1
+                c = vertex_cols + dc - c0 + 1
+                inside = (r >= 0) & (r < edge.shape[0]) & (c >= 0) & (c < edge.shape[1])
+                edge[r[inside], c[inside]] = True
+        edge_rows, edge_cols = np.nonzero(edge[1:-1, 1:-1])
+
+        # exact covered area of the boundary cells, all in one vectorized intersection
+        boxes = shapely.box(x0 + (edge_cols + c0) * self.dx, y0 - (edge_rows + r0 + 1) * self.dy,
+                            x0 + (edge_cols + c0 + 1) * self.dx, y0 - (edge_rows + r0) * self.dy)
+        fraction[edge_rows, edge_cols] = shapely.area(shapely.intersection(boxes, geometry)) / (self.dx * self.dy)
@@ -0,0 +1,123 @@
+import os
+import hashlib
+import sqlite3
+
+from utilities import result_store
+
+
+def manifest_path(database_name):
+    return os.path.join(result_store.tables_dir(), '{}.manifest'.format(os.path.splitext(database_name)[0]))
+
+
+def delete_manifest(database_name):
+    path = manifest_path(database_name)
+
+    for file_path in [path, path + '-wal', path + '-shm']:
+        if os.path.exists(file_path):
+            os.remove(file_path)
+
+
+def path_mtime(path):
+    """
+    Modified time of path, or of the closest folder that exists on disk. Mosaics inside a file geodatabase are
+    not files, so they take the time of the .gdb folder
+    """
+    while path and not os.path.exists(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+
+    return os.path.getmtime(path) if path else None
+
+
+def inputs_hash(paths, params):
+    """
+    Hash of the raster paths and their modified times plus the run parameters (threshold, tcd_categorized...)
+    that the results of an analysis depend on
+    """
+    sha = hashlib.sha1()
+
+    for path in paths:
+        sha.update("{}={}\n".format(path, path_mtime(path)).encode('utf-8'))
+    for key in sorted(params):
+        sha.update("{}={}\n".format(key, params[key]).encode('utf-8'))
+
+    return sha.hexdigest()
+
+
+def geometry_hash(wkb):
+    return hashlib.sha1(bytes(wkb)).hexdigest()
+
+
+class Manifest(object):
+    """ Records which features are done for each analysis, with the inputs hash and geometry hash they were
+    computed with. Kept next to the results database so a crashed run can pick up where it stopped
+    :param path: path to the manifest, a sqlite database
+    :return:
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+        # workers mark their own features, so wait on each other's locks instead of failing. Features are marked
+        # from the writer stage's thread, one thread at a time
+        self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS done (ID INTEGER, analysis TEXT, inputs_hash TEXT, "
+                          "geometry_hash TEXT, PRIMARY KEY (ID, analysis))")
+        self.conn.commit()
+
+    def completed(self, analysis, inputs_hash):
+        """
+        Return {ID: geometry_hash} for the features done for analysis with the same inputs
+        """
+        rows = self.conn.execute("SELECT ID, geometry_hash FROM done WHERE analysis = ? AND inputs_hash = ?",
+                                 (analysis, inputs_hash))
+
+        return dict(rows.fetchall())
+
+    def recorded_ids(self, analysis):
+        return set(x[0] for x in self.conn.execute("SELECT ID FROM done WHERE analysis = ?", (analysis,)))
+
+    def mark_done(self, ids, analysis, inputs_hash, geometry_hashes):
+        rows = [(int(i), analysis, inputs_hash, geometry_hashes.get(int(i))) for i in ids]
+        self.conn.executemany("INSERT OR REPLACE INTO done VALUES (?, ?, ?, ?)", rows)
+        self.conn.commit()
+
+    def forget(self, ids, analysis):
+        self.conn.executemany("DELETE FROM done WHERE ID = ? AND analysis = ?", [(int(i), analysis) for i in ids])
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+
+def pending_features(manifest, inputs_hashes, geometry_hashes, run_mode):
+    """
+    Features that still need to run for any of the analyses
+    :param inputs_hashes: {analysis: inputs hash}
+    :param geometry_hashes: {ID: geometry hash} for every feature in the aoi
+    :param run_mode: fresh runs everything, resume skips features already done with the same inputs, incremental
+    also reruns features whose geometry changed
+    :return: sorted list of IDs
+    """
+    if run_mode == 'fresh':
+        return sorted(geometry_hashes)
+
+    pending = set()
+    for analysis, analysis_hash in inputs_hashes.items():
+        done = manifest.completed(analysis, analysis_hash)
+
+        for i, geom_hash in geometry_hashes.items():
+            if i not in done or (run_mode == 'incremental' and done[i] != geom_hash):
+                pending.add(i)
+
+    return sorted(pending)
+
+
+def stale_features(manifest, analysis, geometry_hashes):
+    """
+    Features recorded in the manifest that are no longer in the aoi
+    """
+    return sorted(manifest.recorded_ids(analysis) - set(geometry_hashes))
@@ -0,0 +1,161 @@
+import os
+import csv
+import json
+import time
+import logging
+import threading
+import contextlib
+
+# stages of a run, in pipeline order, so the report lists them the same way every time
+STAGES = ['projection', 'intersect', 'mask', 'features', 'coverage', 'read', 'zonal', 'dbf_read', 'result_write',
+          'db_to_df', 'group', 'join']
+
+
+class RunReport(object):
+    """ Collects timings of each stage of a run, per feature or per window, with the pixels and bytes read
+    :return:
+    """
+
+    def __init__(self):
+        self.records = []
+        self.counters = {}
+
+        # the pipeline stages count from their own threads
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def stage(self, name, **fields):
+        """
+        Time the block as one record of stage name. Yields the record, so pixel and byte counts found inside the
+        block can be added to it
+        """
+        record = dict(stage=name, **fields)
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record['seconds'] = time.perf_counter() - start
+            self.records.append(record)
+
+    def count(self, name, value):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def gauge(self, name, value):
+        """
+        Keep the largest value seen, for things like queue depth. Gauge names end in _max
+        """
+        with self.lock:
+            self.counters[name] = max(self.counters.get(name, value), value)
+
+    def drain(self):
+        """
+        Return and clear the records and counters, to send them from a worker process to the parent
+        """
+        records, counters = self.records, self.counters
+        self.records, self.counters = [], {}
+
+        return records, counters
+
+    def merge(self, drained):
+        records, counters = drained
+        self.records.extend(records)
+        for name, value in counters.items():
+            if name.endswith('_max'):
+                self.gauge(name, value)
+            else:
+                self.count(name, value)
+
+    def summary(self):
+        """
+        Per stage: count, total seconds, percentiles of the seconds, pixels and bytes read
+        """
+        import numpy as np
+
+        stages = sorted(set(x['stage'] for x in self.records),
+                        key=lambda x: STAGES.index(x) if x in STAGES else len(STAGES))
+        summary = {}
+
+        for name in stages:
+            records = [x for x in self.records if x['stage'] == name]
+            seconds = np.array([x['seconds'] for x in records])
+            p50, p90, p99 = np.percentile(seconds, [50, 90, 99])
+
+            summary[name] = {'count': len(records), 'total_seconds': float(seconds.sum()),
+                             'mean_seconds': float(seconds.mean()), 'p50_seconds': float(p50),
+                             'p90_seconds': float(p90), 'p99_seconds': float(p99), 'max_seconds': float(seconds.max()),
+                             'pixels': int(sum(x.get('pixels', 0) for x in records)),
+                             'bytes_read': int(sum(x.get('bytes_read', 0) for x in records))}
+
+        return summary
+
+    def write(self, out_path):
+        """
+        Write the summary and counters to out_path.json and every record to out_path.csv
+        """
+        summary = self.summary()
+
+        with open(out_path + '.json', 'w') as f:
+            json.dump({'stages': summary, 'counters': self.counters}, f, indent=2)
+
+        fields = ['stage', 'seconds'] + sorted(set(k for x in self.records for k in x) - {'stage', 'seconds'})
+        with open(out_path + '.csv', 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=fields)
+            writer.writeheader()
+            writer.writerows(self.records)
+
+        for name, stats in summary.items():
+            logging.info("{}: {} x, {:.1f} s total, p50 {:.3f} s, p99 {:.3f} s".format(
+                name, stats['count'], stats['total_seconds'], stats['p50_seconds'], stats['p99_seconds']))
+
+
+# one report per process, like the logging module's root logger
+report = RunReport()
+
+
+class Profiler(object):
+    """ Optional cProfile or tracemalloc for a whole run, switched with profile in the config file
+    :param mode: none, cprofile or tracemalloc
+    :return:
+    """
+
+    def __init__(self, mode='none'):
+        self.mode = mode
+        self.profile = None
+
+    def start(self):
+        if self.mode == 'cprofile':
+            import cProfile
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+
+        elif self.mode == 'tracemalloc':
+            import tracemalloc
+            tracemalloc.start()
+
+    def stop(self, out_path):
+        """
+        Write the profile to out_path.prof (cprofile) or the top allocations to out_path_memory.txt (tracemalloc)
+        """
+        if self.mode == 'cprofile':
+            self.profile.disable()
+            self.profile.dump_stats(out_path + '.prof')
+            logging.info("cProfile stats written to {}.prof".format(out_path))
+
+        elif self.mode == 'tracemalloc':
+            import tracemalloc
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            with open(out_path + '_memory.txt', 'w') as f:
+                f.write("peak traced memory: {:.1f} MB\n".format(peak / 1024.0 / 1024.0))
+                for stat in snapshot.statistics('lineno')[:50]:
+                    f.write("{}\n".format(stat))
+
+            logging.info("peak traced memory {:.1f} MB, top allocations in {}_memory.txt".format(
+                peak / 1024.0 / 1024.0, out_path))
+
+
+def report_path(root_dir, output_file_name):
+    return os.path.join(root_dir, 'result', '{}_report'.format(output_file_name))
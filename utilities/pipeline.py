@@ -0,0 +1,131 @@
+import queue
+import threading
+
+from utilities.instrumentation import report
+
+# marks the end of a queue
+_DONE = object()
+
+
+class Prefetcher(object):
+    """ Runs a generator in a background thread, at most depth items ahead of the consumer, so reading the next
+    window overlaps with computing the current one. The deepest the queue got is kept in the report as
+    <name>_queue_max. An exception in the generator is raised again in the consumer
+    :param items: generator of the items to prefetch
+    :param depth: queue depth, 0 runs the generator in the consumer's thread
+    :return:
+    """
+
+    def __init__(self, items, depth=2, name='read'):
+        self.items = items
+        self.depth = depth
+        self.name = name
+        self.error = None
+        self.stopped = threading.Event()
+
+    def __iter__(self):
+        if self.depth <= 0:
+            for item in self.items:
+                yield item
+            return
+
+        self.queue = queue.Queue(self.depth)
+        thread = threading.Thread(target=self.produce, name='{}_stage'.format(self.name), daemon=True)
+        thread.start()
+
+        try:
+            while True:
+                item = self.queue.get()
+                if item is _DONE:
+                    break
+                yield item
+        finally:
+            # a consumer that stops early (or fails) lets the producer finish instead of blocking on a full queue
+            self.stopped.set()
+            while thread.is_alive():
+                try:
+                    self.queue.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            thread.join()
+
+        if self.error is not None:
+            raise self.error
+
+    def produce(self):
+        try:
+            for item in self.items:
+                if self.stopped.is_set():
+                    break
+                self.queue.put(item)
+                report.gauge('{}_queue_max'.format(self.name), self.queue.qsize())
+        except Exception as e:
+            self.error = e
+        finally:
+            self.queue.put(_DONE)
+
+
+class Writer(object):
+    """ Runs write(item) for each item put, in a background thread, so results are written while the next ones are
+    computed. put blocks while depth items are waiting. An exception in write is raised again by the next put or by
+    close
+    :param write: function of one item
+    :param depth: queue depth, 0 writes in the caller's thread
+    :return:
+    """
+
+    def __init__(self, write, depth=2, name='write'):
+        self.write = write
+        self.depth = depth
+        self.name = name
+        self.error = None
+
+        if depth > 0:
+            self.queue = queue.Queue(depth)
+            self.thread = threading.Thread(target=self.consume, name='{}_stage'.format(name), daemon=True)
+            self.thread.start()
+
+    def put(self, item):
+        if self.error is not None:
+            raise self.error
+
+        if self.depth <= 0:
+            self.write(item)
+            return
+
+        self.queue.put(item)
+        report.gauge('{}_queue_max'.format(self.name), self.queue.qsize())
+
+    def consume(self):
+        while True:
+            item = self.queue.get()
+            if item is _DONE:
+                return
+
+            # after an error the rest is drained, so put never blocks on a stopped writer
+            if self.error is None:
+                try:
+                    self.write(item)
+                except Exception as e:
+                    self.error = e
+
+    def close(self):
+        """
+        Wait for everything put to be written
+        """
+        if self.depth > 0:
+            self.queue.put(_DONE)
+            self.thread.join()
+
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        elif self.depth > 0:
+            self.queue.put(_DONE)
+            self.thread.join()
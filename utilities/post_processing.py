@@ -1,48 +1,164 @@
+import os
+import numpy as np
 import pandas as pd
 import logging
 
+from raster_functions import raster_algebra
+
+# the results tables are carried with the smallest types that hold them: codes are below (100 + 2) * 40, feature
+# and group IDs below 2 ** 32, and the sums are float64
+VALUE_DTYPE = np.uint16
+ID_DTYPE = np.uint32
+
+# column and unit of each analysis: the sums are m2 (area) or Mg (biomass x area / 10000), multiplied then divided
+UNITS = {'forest_loss': ('forest_loss_ha', 1, 10000),
+         'forest_extent': ('forest_extent_ha', 1, 10000),
+         'biomass_weight': ('biomass_weight_Tg', 1, 1000000),
+         'emissions': ('emissions_mtc02', 3.67 * .5, 1000000)}
+
+
+def fits(values, dtype):
+    """
+    Mask of the values that dtype holds, so they are not wrapped around when cast to it
+    """
+    info = np.iinfo(dtype)
+
+    return (values >= info.min) & (values <= info.max)
+
+
+def result_frame(values, ids, sums, column):
+    """
+    VALUE, ID, column frame of the compact types. Rows with codes too large for VALUE_DTYPE are not loss + tcd
+    codes, they are logged together and dropped like decode_values does. IDs too large for ID_DTYPE raise a
+    ValueError
+    """
+    values, ids, sums = np.asarray(values), np.asarray(ids), np.asarray(sums, dtype=np.float64)
+
+    valid = fits(values, VALUE_DTYPE)
+    if not valid.all():
+        bad = np.unique(values[~valid])
+        logging.info("oops, {} rows have codes that are not loss + tcd, e.g. {}. Does the loss mosaic have the "
+                     "arithmetic function applied? Refer to readme file".format((~valid).sum(), bad[:10].tolist()))
+        values, ids, sums = values[valid], ids[valid], sums[valid]
+
+    if not fits(ids, ID_DTYPE).all():
+        raise ValueError("IDs up to {} do not fit the results tables as {}".format(ids.max(), np.dtype(ID_DTYPE).name))
+
+    return pd.DataFrame({'VALUE': values.astype(VALUE_DTYPE), 'ID': ids.astype(ID_DTYPE), column: sums})
+
+
+def compact(df):
+    """
+    A VALUE, ID, <analysis> results table (from the result store, with whatever types it kept) of the compact types
+    """
+    column = df.columns[2]
+
+    return result_frame(df['VALUE'].values, df['ID'].values, df[column].values, column)
+
+
+def to_units(df):
+    """
+    A VALUE, ID, <analysis> results table with the sums converted to the unit of the analysis, the column is renamed
+    like forest_loss_ha. A table already converted is returned as it is
+    """
+    column = df.columns[2]
+    if column not in UNITS:
+        return df
+
+    name, multiplier, divisor = UNITS[column]
+
+    return pd.DataFrame({'VALUE': df['VALUE'].values, 'ID': df['ID'].values,
+                         name: df[column].values * multiplier / divisor})
+
+
 def biomass_to_mtc02(layer):
-    layer.emissions.SUM = layer.emissions.SUM.astype(float)
-    layer.emissions['emissions_mtc02'] = layer.emissions.SUM * 3.67 * .5 / 1000000
+    # the results table only has VALUE, ID and the analysis column, there is no SUM column to convert
+    return to_units(layer.emissions)
 
-    del layer.emissions['emissions']
 
-    return layer.emissions
+# the zone codes are loss year (0 = no loss, 1 = 2001...) plus a tcd bin times 40. These lookup arrays are indexed
+# by code and hold the tcd bin and the loss year, so decoding a whole column is one fancy index
+CODE_WIDTH = 40
 
+# tcd_categorized = yes: the tcd mosaic is remapped to 8 bins, 40 = 1-10 %, 80 = 11-15 %...
+TCD_CATEGORIES = ['1-10 %', '11-15 %', '16-20 %', '21-25 %', '26-30 %', '31-50 %', '51-75 %', '76-100 %']
+
+# tcd_categorized = no: raw tcd 0-100 is kept, the code is (tcd + 1) * 40 + loss year
+TCD_EACH = list(range(101))
 
-def value_to_tcd_year(value):
 
-    remap_dict = {
-        1: [{'tcd': '1-10 %', 'sub': 40}],
-        2: [{'tcd': '11-15 %', 'sub': 80}],
-        3: [{'tcd': '16-20 %', 'sub': 120}],
-        4: [{'tcd': '21-25 %', 'sub': 160}],
-        5: [{'tcd': '26-30 %', 'sub': 200}],
-        6: [{'tcd': '31-50 %', 'sub': 240}],
-        7: [{'tcd': '51-75 %', 'sub': 280}],
-        8: [{'tcd': '76-100 %', 'sub': 320}]
-    }
+def build_lookup(n_bins):
+    """
+    tcd bin index (-1 for codes below the first bin) and loss year for every code up to n_bins bins
+    """
+    codes = np.arange((n_bins + 1) * CODE_WIDTH)
+    tcd_index = codes // CODE_WIDTH - 1
+    year = 2000 + codes % CODE_WIDTH
+
+    return tcd_index, year
 
-    # divide the coded value by interval. if its 1.175, use int to get 1
-    div = int(value / 40)
 
-    # look up that value to get TCD
-    tcd = remap_dict[div][0]['tcd']
+CATEGORIZED_LOOKUP = build_lookup(len(TCD_CATEGORIES))
+EACH_LOOKUP = build_lookup(len(TCD_EACH))
 
-    # find this value which is subtraced from the coded value. 47-40 = 7. Gets the year
-    sub = remap_dict[div][0]['sub']
 
-    year = 2000 + (value - sub)
+def decode_values(values, tcd_categorized):
+    """
+    Decode an array of zone codes to tcd and loss year in one go
+    :param values: array of VALUE codes
+    :param tcd_categorized: yes or no, which coding the tcd mosaic was remapped with
+    :return: tcd as a Categorical, year as an int array (2000 is no loss) and a mask of the codes that decoded.
+    Codes outside the lookup are logged together and come back as NaN tcd and year 0
+    """
+    values = np.asarray(values, dtype=np.int64)
+
+    if tcd_categorized == "yes":
+        (tcd_index, year_lookup), categories = CATEGORIZED_LOOKUP, TCD_CATEGORIES
+    else:
+        (tcd_index, year_lookup), categories = EACH_LOOKUP, TCD_EACH
 
-    if year == 2000:
-        year = "no loss"
+    in_range = (values >= 0) & (values < tcd_index.size)
+    safe = np.where(in_range, values, 0)
+    valid = in_range & (tcd_index[safe] >= 0)
+
+    if not valid.all():
+        bad = np.unique(values[~valid])
+        logging.info("oops, {} rows have codes that are not loss + tcd, e.g. {}. Does the loss mosaic have the "
+                     "arithmetic function applied? Refer to readme file".format((~valid).sum(), bad[:10].tolist()))
+
+    codes = np.where(valid, tcd_index[safe], -1)
+    tcd = pd.Categorical.from_codes(codes, categories=categories)
+    year = np.where(valid, year_lookup[safe], 0)
+
+    return tcd, year, valid
+
+
+def year_labels(year):
+    """
+    Loss years as a Categorical, with 2000 shown as no loss
+    """
+    year = np.asarray(year)
+    categories = np.unique(year)
+    labels = ["no loss" if x == 2000 else int(x) for x in categories]
+
+    return pd.Categorical.from_codes(np.searchsorted(categories, year), categories=labels)
+
+
+def value_to_tcd_year(value):
+    """
+    Decode a single code made with the categorized tcd mosaic, see decode_values
+    """
+    tcd, year, valid = decode_values([value], "yes")
+    if not valid[0]:
+        raise KeyError(value)
+
+    return tcd[0], "no loss" if year[0] == 2000 else int(year[0])
 
-    return tcd, year
 
 def value_to_tcd_year_each(value):
     """
     Returns all the value of zonal stats into tcd and year, which preserve the value of tcd 0 - 100
-    value : value from zonal stats (multiplied by forest (x1) and added with remapping tcd raster) 
+    value : value from zonal stats (multiplied by forest (x1) and added with remapping tcd raster)
     """
     """
     You cannot do process forest_extent and forest_loss at the same task to elaborate within this function
@@ -50,25 +166,157 @@ def value_to_tcd_year_each(value):
     In your remap function:
         loss -> +tcd xforest
         forest -> xtcd
-        
+
         then, forest_loss -> +tcd xtcd
         max_number -> 4040 x 4040 = 16321600
 
     """
+    tcd, year, valid = decode_values([value], "no")
+    if not valid[0]:
+        return None
+
+    return tcd[0], "no loss" if year[0] == 2000 else int(year[0])
+
+
+def threshold_tables(df, thresholds, chunk_keys=100000):
+    """
+    Results for several thresholds from one table of raw tcd codes ((tcd + 1) * 40 + loss year, tcd_categorized =
+    no). The rows of each (ID, loss year) form a histogram over tcd 0-100; a reverse cumulative sum over tcd gives
+    the sum above any tcd, so each bin of remap_gt<threshold>.rft.xml is the difference of two cumulative sums
+    :param df: VALUE, ID and the analysis column
+    :param thresholds: list like [10, 30, 'all']
+    :param chunk_keys: number of (ID, loss year) histograms held at once
+    :return: {threshold: VALUE, ID, analysis column frame}, coded like the tcd mosaic remapped for that threshold
+    """
+    column = df.columns[2]
+    values = df['VALUE'].values.astype(np.int64)
+    tcd = values // CODE_WIDTH - 1
+    valid = (tcd >= 0) & (tcd < len(TCD_EACH))
 
-    remap_dict = [dict(tcd=i, sub=(i+1)*40) for i in range(101)]
+    tcd = tcd[valid]
+    year = values[valid] % CODE_WIDTH
+    keys = df['ID'].values[valid].astype(np.int64) * CODE_WIDTH + year
+    sums = df[column].values[valid].astype(np.float64)
 
-    div = int(value / 40)
+    order = np.argsort(keys, kind='stable')
+    keys, tcd, sums = keys[order], tcd[order], sums[order]
+    unique_keys = np.unique(keys)
 
-    # accessing the value by minus 1 since python slicing start with 0 index
-    tcd = remap_dict[div-1]['tcd']
-    sub = remap_dict[div-1]['sub']
+    # bins (tcd min, max) and code of each threshold, bins remapped to 0 are not loss within the threshold
+    bins = {}
+    for threshold in thresholds:
+        remap = raster_algebra.tcd_bins('tcd', threshold)
+        bins[threshold] = [(int(lo), int(hi), code) for (lo, hi), code in
+                           zip(remap.input_ranges, remap.output_values) if code > 0]
 
-    year = 2000 + (value - sub)
-    
-    if year == 2000:
-        year = "no loss"
-    elif year < 2000:
-        return None
-        
-    return tcd, year
+    parts = {threshold: [] for threshold in thresholds}
+    n_tcd = len(TCD_EACH) + 1
+
+    for start in range(0, len(unique_keys), chunk_keys):
+        chunk = unique_keys[start:start + chunk_keys]
+        lo, hi = np.searchsorted(keys, [chunk[0], chunk[-1] + 1])
+        rows = np.searchsorted(chunk, keys[lo:hi])
+
+        # histogram of sums and of rows per (ID, year) and tcd, cumulated from tcd 100 down, with a 0 column
+        # at 101 so the upper edge of the last bin can be indexed
+        flat = rows * n_tcd + tcd[lo:hi]
+        hist = np.bincount(flat, weights=sums[lo:hi], minlength=len(chunk) * n_tcd).reshape(-1, n_tcd)
+        count = np.bincount(flat, minlength=len(chunk) * n_tcd).reshape(-1, n_tcd)
+        hist = hist[:, ::-1].cumsum(axis=1)[:, ::-1]
+        count = count[:, ::-1].cumsum(axis=1)[:, ::-1]
+
+        for threshold in thresholds:
+            for tcd_lo, tcd_hi, code in bins[threshold]:
+                present = count[:, tcd_lo] > count[:, tcd_hi]
+
+                parts[threshold].append(result_frame(code + chunk[present] % CODE_WIDTH,
+                                                     chunk[present] // CODE_WIDTH,
+                                                     hist[present, tcd_lo] - hist[present, tcd_hi], column))
+
+    return {threshold: pd.concat(frames, ignore_index=True) if frames else result_frame([], [], [], column)
+            for threshold, frames in parts.items()}
+
+
+def loss_rows(df, tcd_categorized):
+    """
+    Rows of a results table whose code decodes to a loss year, sorted by ID
+    """
+    tcd, year, valid = decode_values(df['VALUE'].values, tcd_categorized)
+    df = df[valid & (year > 2000)]
+
+    return df.sort_values(['ID', 'VALUE']).reset_index(drop=True)
+
+
+def write_joined(tables, aoi_df, tcd_categorized, threshold, final_output, output_format='csv',
+                 chunk_features=10000):
+    """
+    Join the analysis tables and the aoi columns and write them chunk_features features at a time
+    :param tables: list of VALUE, ID, <column> frames sorted by ID, see loss_rows
+    :param aoi_df: aoi columns indexed by ID, or None to keep the ID column
+    :param output_format: csv or parquet
+    """
+    if os.path.exists(final_output):
+        os.remove(final_output)
+
+    ids = np.unique(np.concatenate([df['ID'].values for df in tables]))
+    writer = None
+
+    # with no rows at all one empty chunk is written, so the output still exists with its header or schema
+    chunks = [ids[start:start + chunk_features] for start in range(0, len(ids), chunk_features)] or [ids]
+
+    for chunk_ids in chunks:
+        lo, hi = (chunk_ids[0], chunk_ids[-1] + 1) if len(chunk_ids) else (0, 0)
+
+        # join all the data frames together on Value and ID. Value is the tcd/loss code (41 = loss in 2001 at
+        # 1-10%tcd or loss in 2001 at >30% tcd. ID is the unique ID of the feature in the shapefile
+        parts = []
+        for df in tables:
+            start, stop = np.searchsorted(df['ID'].values, [lo, hi])
+            parts.append(df.iloc[start:stop].set_index(['VALUE', 'ID']))
+
+        merged = pd.concat(parts, axis=1).reset_index()
+        merged = merged.sort_values(['ID', 'VALUE'])
+
+        tcd, year = decode_values(merged['VALUE'].values, tcd_categorized)[:2]
+        merged['tcd'] = tcd
+        merged['year'] = year_labels(year)
+
+        # the categorized tcd bins are good for when user runs all thresholds, but not just one.
+        # so, overwrite the tcd column when it comes back
+        if threshold != "all" and tcd_categorized == "yes":
+            merged['tcd'] = pd.Categorical(["> {}%".format(threshold)] * len(merged))
+
+        if aoi_df is not None:
+            merged = merged.join(aoi_df, on='ID')
+            del merged['ID']
+
+        if writer is None:
+            print('SAMPLE OF OUTPUT:')
+            print(merged.head(5))
+
+        writer = write_chunk(merged, final_output, output_format, writer)
+
+    if writer is not None and output_format == 'parquet':
+        writer.close()
+
+    logging.info("wrote {} features to {}".format(len(ids), final_output))
+
+
+def write_chunk(df, final_output, output_format, writer):
+    """
+    Append one chunk to the output file. For parquet, writer is the open ParquetWriter, None for the first chunk
+    """
+    if output_format == 'parquet':
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        if writer is None:
+            writer = pq.ParquetWriter(final_output, table.schema)
+        writer.write_table(table.cast(writer.schema))
+
+        return writer
+
+    df.to_csv(final_output, mode='a', header=writer is None, index=False)
+
+    return True
@@ -1,14 +1,24 @@
 import os
-import numpy as np
-import math
-import arcpy
 import logging
 
-def intersect_gp(shapefile, intersect, intersect_col, workspace, out_final_aoi):
+from utilities import checkpoint, result_store, workspace
+
+def intersect_gp(shapefile, intersect, intersect_col, workspace, out_final_aoi, dissolve=True):
+    """
+    Intersect shapefile with the boundary. With dissolve, the pieces are dissolved on intersect_col into one feature
+    per group, without it they are kept and the zonal stats are summed per group afterwards
+    """
+    import arcpy
 
     arcpy.env.overwriteOutput = True
     arcpy.env.workspace = workspace
 
+    if not dissolve:
+        arcpy.Intersect_analysis([shapefile, intersect], out_final_aoi)
+        print("intersected with boundary\n")
+
+        return out_final_aoi
+
     intersected_file = "intersect.shp"
     intersect_col = ';'.join(intersect_col)
 
@@ -23,26 +33,29 @@ def intersect_gp(shapefile, intersect, intersect_col, workspace, out_final_aoi):
     return intersected_file
 
 
-def zonal_stats_mask(final_aoi, i):
+def zonal_stats_mask(final_aoi, i, mask_name="shapefile.shp"):
+    import arcpy
+
     arcpy.env.overwriteOutput = True
-    workspace = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "shapefile")
+    shapefile_dir = workspace.folder("shapefile")
 
     exp = """"FID" = {}""".format(int(i))
 
-    mask = os.path.join(workspace, "shapefile.shp")
+    mask = os.path.join(shapefile_dir, mask_name)
 
-    arcpy.FeatureClassToFeatureClass_conversion(final_aoi, workspace, "shapefile.shp", exp)
+    arcpy.FeatureClassToFeatureClass_conversion(final_aoi, shapefile_dir, mask_name, exp)
 
     return mask
 
 
 def delete_database(database_name):
-    tables_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-    zstats_results_db = os.path.join(tables_dir, 'tables', database_name)
-    
-    if os.path.exists(zstats_results_db):
-        print("deleting database")
-        os.remove(zstats_results_db)
+    # removes the sqlite database (and its WAL files) or the parquet results of a previous run, and its manifest.
+    # Worker stores a crashed run left unmerged go too, or the workers of this run would append to them
+    result_store.delete_store(database_name)
+    for backend in ['sqlite', 'parquet']:
+        for part in result_store.leftover_parts(database_name, backend):
+            result_store.delete_store(part)
+    checkpoint.delete_manifest(database_name)
 
 
 def build_analysis(analysis_requested):
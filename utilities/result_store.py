@@ -0,0 +1,267 @@
+import os
+import glob
+import shutil
+import logging
+import sqlite3
+
+from utilities import workspace
+
+# every analysis table holds these columns, the last one named after the analysis
+COLUMNS = ['VALUE', 'ID', 'SUM']
+
+
+def tables_dir():
+    return workspace.folder('tables')
+
+
+def open_store(database_name, backend='sqlite', batch_rows=100000):
+    """
+    Open the result store for database_name in the tables folder
+    :param backend: sqlite, or parquet for a folder of parquet files per analysis
+    """
+    if backend == 'sqlite':
+        return SqliteResultStore(os.path.join(tables_dir(), database_name), batch_rows)
+    if backend == 'parquet':
+        return ParquetResultStore(os.path.join(tables_dir(), parquet_name(database_name)), batch_rows)
+
+    raise ValueError("unknown result_backend {}, use sqlite or parquet".format(backend))
+
+
+def parquet_name(database_name):
+    return os.path.splitext(database_name)[0] + '.parquet'
+
+
+def delete_store(database_name):
+    """
+    Delete the results of a previous run for either backend
+    """
+    zstats_results_db = os.path.join(tables_dir(), database_name)
+
+    if os.path.exists(zstats_results_db):
+        print("deleting database")
+
+    for path in [zstats_results_db, zstats_results_db + '-wal', zstats_results_db + '-shm']:
+        if os.path.exists(path):
+            os.remove(path)
+
+    parquet_dir = os.path.join(tables_dir(), parquet_name(database_name))
+    if os.path.exists(parquet_dir):
+        print("deleting parquet results")
+        shutil.rmtree(parquet_dir)
+
+
+def part_name(database_name, worker):
+    """
+    Name of the store a worker writes to before it is merged into database_name
+    """
+    root, ext = os.path.splitext(database_name)
+
+    return '{}_worker{}{}'.format(root, worker, ext)
+
+
+def leftover_parts(database_name, backend='sqlite'):
+    """
+    Worker stores left behind by a run that stopped before merging them, in worker order
+    """
+    root, ext = os.path.splitext(database_name)
+    pattern = '{}_worker*{}'.format(root, ext if backend == 'sqlite' else '.parquet')
+    paths = glob.glob(os.path.join(tables_dir(), pattern))
+    workers = sorted(int(os.path.basename(x)[len(root + '_worker'):].split('.')[0]) for x in paths)
+
+    return [part_name(database_name, n) for n in workers]
+
+
+def merge_stores(store, part_names, backend='sqlite'):
+    """
+    Append the results of each part store (one per worker) to store in the order given, then delete the parts.
+    Rows already in store for the same IDs are replaced, so merging a part twice does not duplicate it
+    """
+    for name in part_names:
+        part = open_store(name, backend)
+
+        for analysis in part.analyses():
+            df = part.read(analysis, positive_only=False)
+            store.delete_ids(analysis, df['ID'].unique())
+            store.append(analysis, df)
+
+        part.close()
+        store.commit()
+        delete_store(name)
+
+
+class SqliteResultStore(object):
+    """ Buffers result rows and writes them to sqlite in large batches inside one transaction
+    :param path: path to the sqlite database
+    :param batch_rows: number of buffered rows that triggers a write
+    :return:
+    """
+
+    def __init__(self, path, batch_rows=100000):
+        self.path = path
+        self.batch_rows = batch_rows
+        self.buffers = {}
+        self.buffered = 0
+
+        # the store is written from the writer stage's thread (see pipeline.Writer), one thread at a time
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("PRAGMA temp_store=MEMORY")
+        self.conn.execute("PRAGMA cache_size=-200000")
+
+    def append(self, analysis, df):
+        """
+        Buffer the VALUE, ID, SUM and <analysis> columns of df
+        """
+        if analysis not in self.buffers:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS {} (VALUE INTEGER, ID INTEGER, SUM REAL, {} REAL)"
+                              .format(analysis, analysis))
+            self.buffers[analysis] = []
+
+        rows = df[COLUMNS + [analysis]].astype({'VALUE': int, 'ID': int, 'SUM': float, analysis: float})
+        self.buffers[analysis].extend(zip(*[rows[col].tolist() for col in rows.columns]))
+        self.buffered += len(rows)
+
+        if self.buffered >= self.batch_rows:
+            self.flush()
+
+    def flush(self):
+        for analysis, rows in self.buffers.items():
+            if rows:
+                self.conn.executemany("INSERT INTO {} VALUES (?, ?, ?, ?)".format(analysis), rows)
+                self.buffers[analysis] = []
+
+        self.buffered = 0
+
+    def commit(self):
+        self.flush()
+        self.conn.commit()
+
+    def close(self):
+        """
+        Write what is left, index the tables on (ID, VALUE) and close the connection
+        """
+        self.commit()
+
+        for analysis in self.buffers:
+            self.conn.execute("CREATE INDEX IF NOT EXISTS {0}_id_value ON {0} (ID, VALUE)".format(analysis))
+
+        self.conn.commit()
+        self.conn.close()
+
+    def analyses(self):
+        rows = self.conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+
+        return [x[0] for x in rows]
+
+    def delete_ids(self, analysis, ids):
+        """
+        Delete the rows of analysis for the feature IDs given, before they are run again
+        """
+        if len(ids) == 0 or analysis not in self.analyses():
+            return
+
+        self.flush()
+        self.conn.execute("CREATE TEMP TABLE IF NOT EXISTS delete_ids (ID INTEGER PRIMARY KEY)")
+        self.conn.execute("DELETE FROM delete_ids")
+        self.conn.executemany("INSERT OR IGNORE INTO delete_ids VALUES (?)", [(int(i),) for i in ids])
+        self.conn.execute("DELETE FROM {} WHERE ID IN (SELECT ID FROM delete_ids)".format(analysis))
+
+    def read(self, analysis, positive_only=True):
+        import pandas as pd
+
+        # no feature of the run had any data, e.g. all of them are outside the rasters' tiles
+        if analysis not in self.analyses():
+            logging.info("no sqlite results for {}".format(analysis))
+            return pd.DataFrame(columns=['VALUE', 'ID', analysis] if positive_only else COLUMNS + [analysis])
+
+        if positive_only:
+            qry = "SELECT VALUE, ID, {0} FROM {0} WHERE VALUE > 0".format(analysis)
+        else:
+            qry = "SELECT VALUE, ID, SUM, {0} FROM {0}".format(analysis)
+
+        return pd.read_sql(qry, self.conn)
+
+
+class ParquetResultStore(object):
+    """ Buffers result rows and writes them as parquet files, one folder per analysis and one file per batch
+    :param path: folder holding the analysis folders
+    :param batch_rows: number of buffered rows that triggers a write
+    :return:
+    """
+
+    def __init__(self, path, batch_rows=100000):
+        self.path = path
+        self.batch_rows = batch_rows
+        self.buffers = {}
+        self.buffered = 0
+
+    def append(self, analysis, df):
+        self.buffers.setdefault(analysis, []).append(
+            df[COLUMNS + [analysis]].astype({'VALUE': 'int64', 'ID': 'int64', 'SUM': float, analysis: float}))
+        self.buffered += len(df)
+
+        if self.buffered >= self.batch_rows:
+            self.flush()
+
+    def flush(self):
+        import pandas as pd
+
+        for analysis, frames in self.buffers.items():
+            if not frames:
+                continue
+
+            analysis_dir = os.path.join(self.path, analysis)
+            if not os.path.exists(analysis_dir):
+                os.makedirs(analysis_dir)
+
+            part = len(os.listdir(analysis_dir))
+            out_file = os.path.join(analysis_dir, 'part-{:05d}.parquet'.format(part))
+            pd.concat(frames, ignore_index=True).to_parquet(out_file, index=False)
+            self.buffers[analysis] = []
+
+        self.buffered = 0
+
+    def commit(self):
+        self.flush()
+
+    def close(self):
+        self.flush()
+
+    def analyses(self):
+        if not os.path.exists(self.path):
+            return []
+
+        return sorted(os.listdir(self.path))
+
+    def delete_ids(self, analysis, ids):
+        """
+        Rewrite the files of analysis without the rows for the feature IDs given
+        """
+        analysis_dir = os.path.join(self.path, analysis)
+        if len(ids) == 0 or not os.path.exists(analysis_dir):
+            return
+
+        import pandas as pd
+
+        self.flush()
+        df = pd.read_parquet(analysis_dir)
+        df = df[~df['ID'].isin(ids)]
+
+        shutil.rmtree(analysis_dir)
+        os.makedirs(analysis_dir)
+        df.to_parquet(os.path.join(analysis_dir, 'part-00000.parquet'), index=False)
+
+    def read(self, analysis, positive_only=True):
+        import pandas as pd
+
+        analysis_dir = os.path.join(self.path, analysis)
+        columns = ['VALUE', 'ID', analysis] if positive_only else COLUMNS + [analysis]
+
+        if not os.path.exists(analysis_dir):
+            logging.info("no parquet results for {}".format(analysis))
+            return pd.DataFrame(columns=columns)
+
+        filters = [('VALUE', '>', 0)] if positive_only else None
+
+        return pd.read_parquet(analysis_dir, columns=columns, filters=filters)
@@ -0,0 +1,65 @@
+import numpy as np
+import shapely
+
+# overlaps smaller than this fraction of the smaller feature are rounding along shared edges, not overlaps
+OVERLAP_TOLERANCE = 1e-6
+
+
+class FootprintIndex(object):
+    """ STRtree over the footprints of the tiles the rasters are made of (the items of a mosaic dataset, the
+    sources of a VRT), to tell which features and windows have no data under them before anything is read
+    :param footprints: list of shapely geometries in the rasters' coordinates
+    :return:
+    """
+
+    def __init__(self, footprints):
+        self.footprints = np.array(footprints, dtype=object)
+        self.tree = shapely.STRtree(self.footprints)
+
+    def overlaps(self, bounds):
+        """
+        Whether each box overlaps the bounding box of at least one footprint
+        :param bounds: n x 4 array of xmin, ymin, xmax, ymax
+        :return: bool array, one per box
+        """
+        bounds = np.asarray(bounds, dtype=np.float64).reshape(-1, 4)
+        hit = np.zeros(len(bounds), bool)
+
+        if len(bounds) and len(self.footprints):
+            boxes = shapely.box(bounds[:, 0], bounds[:, 1], bounds[:, 2], bounds[:, 3])
+            hit[np.unique(self.tree.query(boxes)[0])] = True
+
+        return hit
+
+
+def split_empty(feature_bounds, feature_ids, index):
+    """
+    Split feature_ids into the features whose bounding box overlaps a footprint and the ones that have no data
+    :param feature_bounds: {ID: (xmin, ymin, xmax, ymax)}, features without a geometry are left out
+    :return: overlapping IDs, empty IDs, both in the order of feature_ids
+    """
+    bounds = [feature_bounds.get(i, (np.nan,) * 4) for i in feature_ids]
+    hit = index.overlaps(bounds) if feature_ids else np.zeros(0, bool)
+
+    return [i for i, h in zip(feature_ids, hit) if h], [i for i, h in zip(feature_ids, hit) if not h]
+
+
+def overlapping_groups(geometries, groups):
+    """
+    Groups holding two features that overlap each other, so summing the results of the features would count their
+    overlap twice. Features that only touch, like the pieces of one feature cut by a boundary, do not count
+    :param geometries: shapely geometries of the features
+    :param groups: int array of the group of each feature, -1 for features in no group
+    :return: sorted array of the groups
+    """
+    geometries = np.asarray(geometries, dtype=object)
+    groups = np.asarray(groups)
+
+    left, right = shapely.STRtree(geometries).query(geometries, predicate='intersects')
+    same = (left < right) & (groups[left] == groups[right]) & (groups[left] >= 0)
+    left, right = left[same], right[same]
+
+    overlap = shapely.area(shapely.intersection(geometries[left], geometries[right]))
+    smaller = np.minimum(shapely.area(geometries[left]), shapely.area(geometries[right]))
+
+    return np.unique(groups[left][overlap > OVERLAP_TOLERANCE * smaller])
@@ -0,0 +1,134 @@
+import os
+import uuid
+import logging
+import numpy as np
+
+from raster_functions import raster_algebra
+from utilities import checkpoint
+from utilities.instrumentation import report
+
+# width and height in cells of a cached block, cut from the grid of the first source raster
+BLOCK_SIZE = 1024
+
+# zone codes (loss + tcd code, at most 4079) and values (area, biomass per pixel) as they are cached
+ZONE_DTYPE = np.uint16
+VALUE_DTYPE = np.float32
+
+
+def cache_dir():
+    return os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'cache', 'tiles')
+
+
+class TileCache(object):
+    """ Zone codes and values computed from the source rasters, saved in blocks of BLOCK_SIZE cells as .npy files
+    and read back memory mapped. Later runs, and workers running side by side, share the blocks through the page
+    cache instead of reading the rasters and computing the zone codes again. Each expression has its own folder,
+    keyed on its source rasters' paths and modified times, so blocks of a raster that changed are never read
+    :param grid_raster: path of the raster whose grid the blocks are cut from, the first raster of the feature grid
+    :param block_size: cells per side of a block
+    :return:
+    """
+
+    def __init__(self, grid_raster, block_size=BLOCK_SIZE):
+        self.grid_raster = grid_raster
+        self.block_size = block_size
+        self.entries = {}
+
+    def entry(self, raster, dtype):
+        """
+        Folder of the blocks of raster (a path or raster_algebra expression) cached as dtype
+        """
+        key = (repr(raster), np.dtype(dtype).name)
+
+        if key not in self.entries:
+            paths = [self.grid_raster] + raster_algebra.sources([raster])
+            params = {'raster': key[0], 'dtype': key[1], 'block_size': self.block_size}
+            self.entries[key] = os.path.join(cache_dir(), checkpoint.inputs_hash(paths, params))
+
+            if not os.path.exists(self.entries[key]):
+                os.makedirs(self.entries[key], exist_ok=True)
+
+        return self.entries[key]
+
+    def evaluate(self, rasters, dtypes, grid, window, windows=None):
+        """
+        Like raster_algebra.evaluate, from the cached blocks. Blocks not cached yet are computed whole from one read
+        of their source rasters and saved first
+        :param dtypes: dtype each raster is cached as, like ZONE_DTYPE for the zone and VALUE_DTYPE for values
+        :param grid: feature grid of a backend, window is a window of it that does not cross a block boundary (see
+        tiling.iter_windows)
+        :param windows: dict filled with the source windows read for the blocks computed, by path
+        :return: read only arrays, views of the memory mapped blocks
+        """
+        row_off, col_off, nrows, ncols = window
+        row, col = grid.row0 + row_off, grid.col0 + col_off
+        block_row, block_col = row // self.block_size, col // self.block_size
+
+        paths = [os.path.join(self.entry(raster, dtype), '{}_{}.npy'.format(block_row, block_col))
+                 for raster, dtype in zip(rasters, dtypes)]
+        missing = [k for k, path in enumerate(paths) if not os.path.exists(path)]
+
+        # a block's modified time is its last use, for eviction
+        for k, path in enumerate(paths):
+            if k not in missing:
+                os.utime(path, None)
+
+        report.count('tile_cache_hits', len(paths) - len(missing))
+        report.count('tile_cache_misses', len(missing))
+
+        if missing:
+            block_window = (block_row * self.block_size - grid.row0, block_col * self.block_size - grid.col0,
+                            self.block_size, self.block_size)
+            blocks = raster_algebra.evaluate([rasters[k] for k in missing], grid.read, block_window, windows)
+
+            for k, block in zip(missing, blocks):
+                save_block(paths[k], block, dtypes[k])
+
+        r, c = row - block_row * self.block_size, col - block_col * self.block_size
+
+        return [np.load(path, mmap_mode='r')[r:r + nrows, c:c + ncols] for path in paths]
+
+
+def save_block(path, block, dtype):
+    """
+    Save block as dtype, through a temporary file so a worker never maps a block another worker is still writing
+    """
+    dtype = np.dtype(dtype)
+    if dtype.kind in 'iu' and block.size and (block.min() < np.iinfo(dtype).min or block.max() > np.iinfo(dtype).max):
+        raise ValueError("zone codes up to {} do not fit the tile cache as {}, set tile_cache_mb = 0"
+                         .format(block.max(), dtype.name))
+
+    tmp_path = '{}.{}.tmp.npy'.format(path, uuid.uuid4().hex)
+    np.save(tmp_path, np.ascontiguousarray(block, dtype=dtype))
+    os.replace(tmp_path, path)
+
+
+def evict(max_size_mb):
+    """
+    Delete the least recently used blocks until the cache fits in max_size_mb, and the folders left empty
+    """
+    if not os.path.exists(cache_dir()):
+        return
+
+    blocks = []
+    for entry in os.listdir(cache_dir()):
+        entry_dir = os.path.join(cache_dir(), entry)
+        for name in os.listdir(entry_dir):
+            stat = os.stat(os.path.join(entry_dir, name))
+            blocks.append((stat.st_mtime, stat.st_size, os.path.join(entry_dir, name)))
+    total = sum(size for _, size, _ in blocks)
+
+    if total > max_size_mb * 1024 * 1024:
+        logging.info("tile cache is {:.0f} MB, evicting down to {} MB".format(total / 1024.0 / 1024, max_size_mb))
+
+    for _, size, path in sorted(blocks):
+        if total <= max_size_mb * 1024 * 1024:
+            break
+
+        total -= size
+        os.remove(path)
+
+    for entry in os.listdir(cache_dir()):
+        entry_dir = os.path.join(cache_dir(), entry)
+        if not os.listdir(entry_dir):
+            os.rmdir(entry_dir)
@@ -0,0 +1,115 @@
+import logging
+import numpy as np
+
+# peak bytes held for a window, see zstats_handler.zstats_chunk. Per pixel of each grid: the source windows as read
+# and the zone and value grids computed from them, 8 bytes at most
+GRID_BYTES = 8
+# per pixel while the cells of one feature are found: the x and y cell centers of its bounding box, the contains_xy
+# mask, the fractions and the rows and columns of the cells it covers (see cell_coverage.FeatureIndex)
+FEATURE_BYTES = 41
+# per (cell, feature) pair of a window: the cell, ID and fraction the coverage returns
+PAIR_BYTES = 24
+# per pair while the window is summed: the zone codes, the cells, fractions, IDs and codes left once nodata is
+# dropped and the keys of group_sums. The weighted values add 8 bytes per value grid
+SUM_BYTES = 64
+
+
+def tile_size_for_memory(tile_size, max_memory_mb, bytes_per_pixel, window_pairs=None, bytes_per_pair=0):
+    """
+    Shrink the requested tile size until one window fits in the memory cap
+    :param bytes_per_pixel: bytes held per pixel of a window, whatever the features
+    :param window_pairs: function of a tile size returning the most (cell, feature) pairs of one window, see
+    cell_coverage.FeatureIndex.window_pairs
+    :param bytes_per_pair: bytes held per pair
+    """
+    max_bytes = int(max_memory_mb) * 1024 * 1024
+    capped = min(tile_size, max(int(np.sqrt(max_bytes // bytes_per_pixel)), 1))
+
+    # overlapping features hold several pairs per pixel
+    while capped > 1 and window_pairs is not None and \
+            capped * capped * bytes_per_pixel + window_pairs(capped) * bytes_per_pair > max_bytes:
+        capped //= 2
+
+    if capped < tile_size:
+        logging.info("tile size {0} does not fit in {1} MB, using {2}x{2} windows".format(tile_size, max_memory_mb,
+                                                                                           capped))
+
+    return capped
+
+
+def aligned_tile_size(tile_size, block_size):
+    """
+    Largest tile size up to tile_size that divides block_size (a power of 2), so aligned windows never cross a block
+    """
+    aligned = block_size
+    while aligned > max(tile_size, 1):
+        aligned //= 2
+
+    return aligned
+
+
+def iter_windows(nrows, ncols, tile_size, grid_row=0, grid_col=0):
+    """
+    Yield (row_off, col_off, height, width) windows covering an nrows x ncols grid, row by row
+    :param grid_row, grid_col: position of the grid in a larger grid, windows are cut at multiples of tile_size in
+    the larger grid
+    """
+    for row_start in range(-(grid_row % tile_size), nrows, tile_size):
+        row_off = max(row_start, 0)
+        for col_start in range(-(grid_col % tile_size), ncols, tile_size):
+            col_off = max(col_start, 0)
+            yield (row_off, col_off, min(row_start + tile_size, nrows) - row_off,
+                   min(col_start + tile_size, ncols) - col_off)
+
+
+class Accumulator(object):
+    """ Collects partial (ID, VALUE) sums from each window and merges them. Sums are 2-d, one column per value
+    raster
+    :param max_rows: number of buffered partial rows that triggers a merge, keeps the buffer bounded
+    :return:
+    """
+
+    def __init__(self, max_rows=5000000):
+        self.max_rows = max_rows
+        self.parts = []
+        self.buffered = 0
+
+    def add(self, ids, codes, sums):
+        if ids.size == 0:
+            return
+
+        self.parts.append((ids, codes, sums))
+        self.buffered += ids.size
+
+        if self.buffered > self.max_rows:
+            self.merge()
+
+    def merge(self):
+        if len(self.parts) < 2:
+            return
+
+        ids = np.concatenate([p[0] for p in self.parts])
+        codes = np.concatenate([p[1] for p in self.parts])
+        sums = np.concatenate([p[2] for p in self.parts])
+
+        # same combined key as zonal_engine.group_sums, compacted since the merged key space can be large
+        n_codes = int(codes.max()) + 1
+        keys, inverse = np.unique(ids * n_codes + codes, return_inverse=True)
+        inverse = inverse.ravel()
+        sums = np.stack([np.bincount(inverse, weights=sums[:, k]) for k in range(sums.shape[1])], axis=1)
+
+        self.parts = [(keys // n_codes, keys % n_codes, sums)]
+        self.buffered = keys.size
+
+    def result(self):
+        """
+        Return the merged ids, codes, sums sorted by ID then VALUE
+        """
+        if not self.parts:
+            return np.empty(0, np.int64), np.empty(0, np.int64), np.empty((0, 0), np.float64)
+
+        self.merge()
+        ids, codes, sums = self.parts[0]
+        order = np.lexsort((codes, ids))
+
+        return ids[order], codes[order], sums[order]
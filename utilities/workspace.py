@@ -0,0 +1,32 @@
+import os
+
+# the repository folder. The tables, shapefile and result folders are in it unless a job folder is set, the caches
+# always are, so every job shares them
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# folder of the job this process is running, see set_job_dir
+_job_dir = None
+
+
+def set_job_dir(job_dir):
+    """
+    Put the tables, shapefile and result folders and the scratch geodatabases of this process in job_dir, so jobs
+    running side by side never share them. None goes back to the repository folder
+    """
+    global _job_dir
+    _job_dir = os.path.abspath(job_dir) if job_dir else None
+
+
+def job_dir():
+    return _job_dir or ROOT_DIR
+
+
+def folder(name):
+    """
+    The tables, shapefile or result folder of the current job, created if it is missing
+    """
+    path = os.path.join(job_dir(), name)
+    if not os.path.exists(path):
+        os.makedirs(path, exist_ok=True)
+
+    return path
@@ -0,0 +1,96 @@
+import logging
+import numpy as np
+import pandas as pd
+
+from utilities import post_processing
+
+# above this many (ID, VALUE) slots a dense bincount would allocate more than it saves, so the keys
+# are compacted with np.unique first
+MAX_DENSE_KEYS = 2 ** 25
+
+
+def weighted_zonal_sums(cells, ids, fractions, zone_grid, value_grids, zone_nodata=0):
+    """
+    Sum several value grids within every (feature ID, zone code) pair, all features at once, each value weighted by
+    the fraction of the cell the feature covers. The zone grid is only grouped once however many value grids share it
+    :param cells: flat indexes into the grids, with ids and fractions one per (cell, feature), see
+    cell_coverage.FeatureIndex.fractions
+    :param zone_grid: int array of zone codes (loss + tcd)
+    :param value_grids: list of arrays of values to sum (area, biomass), aligned with zone_grid
+    :return: ids, codes as 1-d arrays and sums as a 2-d array with one column per value grid, one row per pair
+    that has at least one pixel
+    """
+    codes = zone_grid.ravel()[cells]
+    valid = codes != zone_nodata
+    cells, fractions = cells[valid], fractions[valid]
+
+    values = [value_grid.ravel()[cells].astype(np.float64) * fractions for value_grid in value_grids]
+
+    return group_sums(ids[valid], codes[valid], values)
+
+
+def group_sums(ids, codes, values):
+    """
+    Sum each array of values per (ID, code) pair
+    """
+    ids = ids.astype(np.int64)
+    codes = codes.astype(np.int64)
+
+    if ids.size == 0:
+        return np.empty(0, np.int64), np.empty(0, np.int64), np.empty((0, len(values)), np.float64)
+
+    # combine ID and VALUE into one key so a single bincount does the group by
+    n_codes = int(codes.max()) + 1
+    keys = ids * n_codes + codes
+
+    dense = (int(ids.max()) + 1) * n_codes <= MAX_DENSE_KEYS
+
+    if dense:
+        present = np.flatnonzero(np.bincount(keys))
+        inverse = keys
+    else:
+        present, inverse = np.unique(keys, return_inverse=True)
+        inverse = inverse.ravel()
+
+    sums = np.empty((present.size, len(values)), np.float64)
+    for k, column_values in enumerate(values):
+        column_values = column_values.astype(np.float64)
+        column_values[~np.isfinite(column_values)] = 0
+
+        column = np.bincount(inverse, weights=column_values)
+        sums[:, k] = column[present] if dense else column
+
+    return present // n_codes, present % n_codes, sums
+
+
+def sums_to_df(ids, codes, sums, analysis):
+    """
+    Shape the zonal sums like the rows zstats appends to the sql database
+    """
+    df = pd.DataFrame({'VALUE': codes.astype(int), 'ID': ids.astype(int), 'SUM': sums})
+    df[analysis] = df['SUM']
+
+    logging.info("{} (ID, VALUE) rows for {}".format(len(df), analysis))
+
+    return df
+
+
+def group_table(df, feature_groups):
+    """
+    Sum a results table per (group, VALUE) instead of per (ID, VALUE), so features cut by a boundary add up to the
+    boundary's groups without dissolving them first
+    :param df: VALUE, ID, <analysis> frame
+    :param feature_groups: int array of the group of each FID, -1 for features in no group
+    :return: VALUE, ID, <analysis> frame where ID is the group
+    """
+    analysis = df.columns[2]
+    ids = df['ID'].values.astype(np.int64)
+
+    groups = np.full(ids.size, -1, np.int64)
+    known = (ids >= 0) & (ids < feature_groups.size)
+    groups[known] = feature_groups[ids[known]]
+    keep = groups >= 0
+
+    group_ids, codes, sums = group_sums(groups[keep], df['VALUE'].values[keep], [df[analysis].values[keep]])
+
+    return post_processing.result_frame(codes, group_ids, sums[:, 0], analysis)
@@ -1,61 +1,100 @@
-import subprocess
-import arcpy
 import os
-import sys
 import logging
 
-import sqlite3
-from arcpy.sa import *
-import datetime
-import geopandas as gpd
-import pandas as pd
-from utilities import prep_shapefile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import backends
+from raster_functions import raster_algebra
+from utilities import aoi_reader, cell_coverage, checkpoint, pipeline, prep_shapefile, result_store, spatial_index, \
+    tile_cache, tiling, workspace, zonal_engine
+from utilities.instrumentation import report
 
-def gdf2pd(dbfile):
+def gdf2pd(dbfile, columns=None):
     """
-    Convert dbf to pandas dataframe using geopandas
+    Convert dbf to pandas dataframe, only the attributes are read and never the geometries, see
+    aoi_reader.read_attributes
+    :param columns: only read these columns
     """
-    gdf = gpd.read_file(dbfile)
-    df = pd.DataFrame(gdf.drop('geometry', axis=1))
+    return aoi_reader.read_attributes(dbfile, columns)
 
-    return df
 
+def split_ids(feature_ids, n_chunks=None, chunk_size=None):
+    """
+    Split a sorted list of feature IDs into n_chunks contiguous lists, or lists of chunk_size IDs
+    """
+    if chunk_size:
+        return [feature_ids[k:k + chunk_size] for k in range(0, len(feature_ids), chunk_size)]
 
-def zstats(start, stop, final_aoi, cellsize, value, zone, analysis, database_name):
+    return [list(x) for x in np.array_split(feature_ids, n_chunks) if len(x)]
 
-    arcpy.CheckOutExtension("Spatial")
-    arcpy.env.overwriteOutput = True
 
-    for i in range(start, stop):
-        print("prepping feature id {}".format(i))
+def fid_where(feature_ids):
+    """
+    Where clause selecting feature_ids, as a range when they are contiguous
+    """
+    start, stop = int(feature_ids[0]), int(feature_ids[-1]) + 1
 
-        # select one individual feature from the input shapefile
-        mask = prep_shapefile.zonal_stats_mask(final_aoi, i)
+    if stop - start == len(feature_ids):
+        return """"FID" >= {} AND "FID" < {}""".format(start, stop)
 
-        scratch_wkspc = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'scratch.gdb')
+    return """"FID" IN ({})""".format(", ".join(str(int(i)) for i in feature_ids))
 
-        # set environments
-        arcpy.env.extent = mask
-        arcpy.env.mask = mask
-        arcpy.env.cellSize = cellsize
-        arcpy.env.snapRaster = value
-        arcpy.env.scratchWorkspace = scratch_wkspc
-        arcpy.env.workspace = scratch_wkspc
 
-        tables_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'tables')
+def worker_scratch(worker):
+    """
+    Scratch geodatabase for a worker, so workers running side by side never share scratch rasters
+    """
+    import arcpy
+
+    root_dir = workspace.job_dir()
+
+    if worker is None:
+        return os.path.join(root_dir, 'scratch.gdb')
 
-        z_stats_tbl = os.path.join(tables_dir, 'output_{}.dbf'.format(i))
+    scratch_name = 'scratch_{}.gdb'.format(worker)
+    scratch_wkspc = os.path.join(root_dir, scratch_name)
+    if not arcpy.Exists(scratch_wkspc):
+        arcpy.CreateFileGDB_management(root_dir, scratch_name)
 
-        start_time = datetime.datetime.now()
-        
-        print("running zstats")
-        outzstats = arcpy.sa.ZonalStatisticsAsTable(zone, "VALUE", value, z_stats_tbl, "DATA", "SUM")
+    return scratch_wkspc
 
-        end_time = datetime.datetime.now() - start_time
-        print("debug:time elapsed: {}".format(end_time))
+
+def zstats(feature_ids, final_aoi, cellsize, value, zone, analysis, database_name, worker=None,
+           result_backend='sqlite', checkpoint_info=None, queue_depth=2, checkpoint_every=50):
+    """
+    ZonalStatisticsAsTable once per feature. The output tables are read and written to the store in a background
+    thread, up to queue_depth features behind, while the next features are masked and run
+    :param checkpoint_info: (manifest path, inputs hash, {ID: geometry hash}). Features are marked done in the
+    manifest every checkpoint_every features, once their rows are committed
+    """
+    import arcpy.sa
+
+    arcpy.CheckOutExtension("Spatial")
+    arcpy.env.overwriteOutput = True
+
+    # rows are buffered and written in batches, not one transaction per feature
+    store = result_store.open_store(database_name, result_backend)
+
+    manifest = None
+    if checkpoint_info:
+        manifest_file, inputs_hash, geometry_hashes = checkpoint_info
+        manifest = checkpoint.Manifest(manifest_file)
+    done_ids = []
+
+    scratch_wkspc = worker_scratch(worker)
+    mask_name = 'shapefile.shp' if worker is None else 'shapefile_{}.shp'.format(worker)
+    table_prefix = 'output_' if worker is None else 'output_{}_'.format(worker)
+
+    def write_table(item):
+        i, z_stats_tbl, record = item
 
         # convert the output zstats table into a pandas DF
-        df = gdf2pd(z_stats_tbl)
+        with report.stage('dbf_read', feature=i):
+            df = gdf2pd(z_stats_tbl)
+
+        if 'COUNT' in df.columns:
+            record['pixels'] = int(df['COUNT'].sum())
 
         # populate a new field "id" with the FID and analysis with the sum
         df['ID'] = i
@@ -64,45 +103,365 @@ def zstats(start, stop, final_aoi, cellsize, value, zone, analysis, database_nam
         # sometimes this value came back as an object, so here we are fixing that bug
         df.VALUE = df.VALUE.astype(int)
 
-        # name of the sql database to store the sql table
-        zstats_results_db = os.path.join(tables_dir, database_name)
-
-        # create a connection to the sql database
-        conn = sqlite3.connect(zstats_results_db)
-
-        # append the dataframe to the database
-        df.to_sql(analysis, conn, if_exists='append')
+        # append the dataframe to the results
+        with report.stage('result_write', feature=i):
+            store.append(analysis, df)
 
         # delete these because they create a lock
         del df
         os.remove(z_stats_tbl)
 
-        # reset these environments. Otherwise the shapefile is redefined based on features within the extent
-        arcpy.env.extent = None
-        arcpy.env.mask = None
-        arcpy.env.cellSize = None
-        arcpy.env.snapRaster = None
-
         print('process succeeded for id {0}'.format(i))
 
+        done_ids.append(i)
+        if manifest and len(done_ids) >= checkpoint_every:
+            store.commit()
+            manifest.mark_done(done_ids, analysis, inputs_hash, geometry_hashes)
+            del done_ids[:]
+
+    # arcpy geoprocessing stays in this thread, the writer only reads dbf tables and writes the store
+    with pipeline.Writer(write_table, queue_depth) as writer:
+        for i in feature_ids:
+            print("prepping feature id {}".format(i))
+
+            # select one individual feature from the input shapefile
+            with report.stage('mask', feature=i):
+                mask = prep_shapefile.zonal_stats_mask(final_aoi, i, mask_name)
+
+            # set environments
+            arcpy.env.extent = mask
+            arcpy.env.mask = mask
+            arcpy.env.cellSize = cellsize
+            arcpy.env.snapRaster = value
+            arcpy.env.scratchWorkspace = scratch_wkspc
+            arcpy.env.workspace = scratch_wkspc
+
+            z_stats_tbl = os.path.join(result_store.tables_dir(), '{}{}.dbf'.format(table_prefix, i))
+
+            print("running zstats")
+            with report.stage('zonal', feature=i, analysis=analysis) as record:
+                outzstats = arcpy.sa.ZonalStatisticsAsTable(zone, "VALUE", value, z_stats_tbl, "DATA", "SUM")
+
+            # reset these environments. Otherwise the shapefile is redefined based on features within the extent
+            arcpy.env.extent = None
+            arcpy.env.mask = None
+            arcpy.env.cellSize = None
+            arcpy.env.snapRaster = None
+
+            writer.put((i, z_stats_tbl, record))
+
+    store.close()
+
+    if manifest:
+        manifest.mark_done(done_ids, analysis, inputs_hash, geometry_hashes)
+        manifest.close()
+
+
+def footprint_index(backend, rasters):
+    """
+    FootprintIndex over the tiles of every source raster of the zones and values of rasters
+    """
+    paths = raster_algebra.sources([x for raster in rasters for x in [raster.zone, raster.value]])
+
+    return spatial_index.FootprintIndex([footprint for path in paths for footprint in backend.footprints(path)])
+
+
+def zstats_chunk(backend, final_aoi, values, zone, feature_ids, tile_size=4096, max_memory_mb=2048, coverage='center',
+                 footprints=None, cache_tiles=False, queue_depth=2, worker=None):
+    """
+    Numpy zonal stats for the features in feature_ids: read the zone grid window by window over the union extent
+    of the features, find the cells of the window each feature covers and sum every value raster per (ID, VALUE)
+    from the same zone read. Each feature gets all the cells it covers, so where features overlap a cell counts for
+    each of them, like the arcpy engine, and the results do not depend on which features share a chunk. The windows
+    are read in a background thread, up to queue_depth windows ahead of the zonal sums, so the disk and the CPU
+    work at the same time
+    :param backend: raster backend (see backends.open_backend) that reads the features and the windows
+    :param values: value raster paths or raster_algebra expressions, computed window by window from their source
+    rasters. Same for zone
+    :param coverage: center counts a cell for every feature that holds its center. exact weights each cell by the
+    fraction of it each feature covers, for small and sliver polygons
+    :param footprints: FootprintIndex of the rasters' tiles, windows outside every tile are skipped without reading
+    :param cache_tiles: read the zone codes and values from the tile cache (see tile_cache.TileCache), computing
+    and saving the blocks that are not cached yet
+    :param queue_depth: windows read ahead, 0 reads and sums one window after the other in this thread. Backends
+    that are not thread_safe always read in this thread
+    :return: ids, codes arrays sorted by ID then VALUE, and sums with one column per value raster
+    """
+    rasters = raster_algebra.sources(values + [zone])
+    if not backend.thread_safe:
+        queue_depth = 0
+
+    print("reading feature ids {} to {}".format(feature_ids[0], feature_ids[-1]))
+    with report.stage('features', first_feature=feature_ids[0], features=len(feature_ids)):
+        grid = backend.feature_grid(final_aoi, feature_ids, rasters, worker)
+        index = cell_coverage.FeatureIndex(grid.geometries(), grid.cell_size(), coverage)
+
+    # windows are cut on the cache's blocks, so each one is a slice of one memory mapped block
+    grid_offset = (grid.row0, grid.col0) if cache_tiles else (0, 0)
+
+    # the window being summed and the windows waiting in the queue each hold their zone and value grids and their
+    # (cell, feature) pairs. The window being read also holds its source windows and the coverage of one feature,
+    # and the one being summed the copies the weighted sums make of its pairs
+    bytes_per_pixel = tiling.GRID_BYTES * ((queue_depth + 1) * (len(values) + 1) + len(rasters)) + \
+        tiling.FEATURE_BYTES
+    bytes_per_pair = (queue_depth + 1) * tiling.PAIR_BYTES + tiling.SUM_BYTES + 8 * len(values)
+    grid_x0, grid_y0 = grid.window_origin((0, 0, grid.height, grid.width))
+    tile_size = tiling.tile_size_for_memory(
+        tile_size, max_memory_mb, bytes_per_pixel,
+        lambda size: index.window_pairs(grid_x0, grid_y0, grid.height, grid.width, size, *grid_offset), bytes_per_pair)
+    acc = tiling.Accumulator()
+    dx, dy = grid.cell_size()
+
+    cache = None
+    if cache_tiles:
+        cache = tile_cache.TileCache(rasters[0])
+        tile_size = tiling.aligned_tile_size(tile_size, cache.block_size)
+        dtypes = [tile_cache.ZONE_DTYPE] + [tile_cache.VALUE_DTYPE] * len(values)
+
+    def read_windows():
+        for window in tiling.iter_windows(grid.height, grid.width, tile_size, *grid_offset):
+            window_name = '{}_{}'.format(window[0], window[1])
+            x0, y0 = grid.window_origin(window)
+
+            # windows in the union extent of the features that fall between the tiles of the rasters
+            if footprints is not None and not footprints.overlaps([x0, y0 - window[2] * dy, x0 + window[3] * dx,
+                                                                    y0])[0]:
+                report.count('empty_windows', 1)
+                continue
+
+            with report.stage('coverage', window=window_name, first_feature=feature_ids[0]) as record:
+                coverage_cells = index.fractions(x0, y0, window[2], window[3])
+                record['cells'] = coverage_cells[0].size
 
-def main_script(layer, raster, database_name):
+            # windows in the union extent that no feature covers
+            if coverage_cells[0].size == 0:
+                report.count('empty_windows', 1)
+                continue
+
+            with report.stage('read', window=window_name, first_feature=feature_ids[0]) as record:
+
+                # each source raster is read once, zone codes and weighted values are computed from the same read
+                windows = {}
+                if cache is None:
+                    grids = raster_algebra.evaluate([zone] + values, grid.read, window, windows)
+                else:
+                    grids = cache.evaluate([zone] + values, dtypes, grid, window, windows)
+                record['pixels'] = window[2] * window[3]
+                record['bytes_read'] = sum(x.nbytes for x in windows.values())
+                del windows
+
+            yield window_name, window[2] * window[3], coverage_cells, grids
+
+    try:
+        for window_name, pixels, coverage_cells, grids in pipeline.Prefetcher(read_windows(), queue_depth):
+            with report.stage('zonal', window=window_name, first_feature=feature_ids[0], pixels=pixels):
+                zone_grid, value_grids = grids[0], grids[1:]
+                acc.add(*zonal_engine.weighted_zonal_sums(*coverage_cells, zone_grid, value_grids))
+            del zone_grid, value_grids, grids, coverage_cells
+    finally:
+        grid.close()
+
+    return acc.result()
+
+
+# index of this worker process in the pool, so it reuses one scratch workspace for all its chunks
+_worker_slot = None
+
+
+def _init_worker(slots, job_dir):
+    global _worker_slot
+    _worker_slot = slots.get()
+    workspace.set_job_dir(job_dir)
+
+    # a forked worker starts with a copy of the parent's timings, which the parent already has
+    report.drain()
+
+
+def _zstats_chunk_worker(args):
+    # the timings go back to the parent with the results, each process has its own report
+    return zstats_chunk(*args, worker=_worker_slot), report.drain()
+
+
+def _zstats_worker(args):
+    zstats(*args)
+    return report.drain()
+
+
+def zstats_numpy(backend, final_aoi, values, zone, analyses, database_name, feature_ids, workers=1, tile_size=4096,
+                 max_memory_mb=2048, result_backend='sqlite', chunk_size=1000, manifest=None, inputs_hashes=None,
+                 geometry_hashes=None, coverage='center', footprints=None, cache_tiles=False, queue_depth=2):
+    """
+    Run the numpy engine over feature_ids in chunks of chunk_size features, spread over the workers, and write one
+    table per analysis. values and analyses are parallel lists of analyses that share the zone raster. Chunks are
+    written in FID order as they finish, so the tables are the same whatever the number of workers, and each
+    chunk is committed and marked done in the manifest before the next one is written. The writes run in a
+    background thread, up to queue_depth chunks behind the zonal stats
+    """
+    store = result_store.open_store(database_name, result_backend)
+    chunks = split_ids(feature_ids, chunk_size=chunk_size or int(np.ceil(len(feature_ids) / float(workers))))
+
+    print("running zstats for {}".format(", ".join(analyses)))
+    if workers > 1:
+        # the memory cap is for the whole run, each worker holds one window at a time
+        jobs = [(backend, final_aoi, values, zone, chunk, tile_size, max_memory_mb // workers, coverage, footprints,
+                 cache_tiles, queue_depth) for chunk in chunks]
+
+        slots = multiprocessing.Queue()
+        for n in range(workers):
+            slots.put(n)
+
+        executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                       initargs=(slots, workspace.job_dir()))
+        results = executor.map(_zstats_chunk_worker, jobs)
+    else:
+        executor = None
+        results = ((zstats_chunk(backend, final_aoi, values, zone, chunk, tile_size, max_memory_mb, coverage,
+                                 footprints, cache_tiles, queue_depth), None) for chunk in chunks)
+
+    def write_chunk(item):
+        chunk, ids, codes, sums = item
+
+        with report.stage('result_write', first_feature=chunk[0], features=len(chunk)):
+            for k, analysis in enumerate(analyses):
+                store.append(analysis, zonal_engine.sums_to_df(ids, codes, sums[:, k], analysis))
+
+            store.commit()
+        if manifest:
+            for analysis in analyses:
+                manifest.mark_done(chunk, analysis, inputs_hashes[analysis], geometry_hashes)
+
+    with pipeline.Writer(write_chunk, queue_depth) as writer:
+        for chunk, ((ids, codes, sums), timings) in zip(chunks, results):
+            if timings:
+                report.merge(timings)
+            writer.put((chunk, ids, codes, sums.reshape(-1, len(values))))
+
+    if executor:
+        executor.shutdown()
+
+    store.close()
+
+
+def main_script(layer, rasters, database_name, engine='numpy', workers=1, tile_size=4096, max_memory_mb=2048,
+                result_backend='sqlite', run_mode='fresh', chunk_size=1000, run_params=None, backend=None,
+                coverage='center', tile_cache_mb=0, queue_depth=2):
+    """
+    Run zonal stats for rasters, a list of Raster objects for analyses that share one zone raster (see
+    raster.group_by_zone). The numpy engine sums all of them from one read of the zone raster, the arcpy engine
+    runs them one after the other.
+    Finished features are recorded in a manifest next to the results. run_mode resume skips features already
+    done with the same inputs, incremental also reruns features whose geometry changed and drops the results of
+    features no longer in the aoi.
+    Features whose bounding box overlaps no tile of the rasters are marked done with no rows, without being masked
+    or read
+    :param backend: raster backend from backends.open_backend, arcpy if not given. The arcpy engine needs the
+    arcpy backend
+    :param coverage: center or exact, see zstats_chunk. numpy engine only
+    :param tile_cache_mb: size of the tile cache of zone codes and values, 0 to read the rasters every time. numpy
+    engine only
+    :param queue_depth: windows read ahead and results waiting to be written, see pipeline. 0 runs every stage one
+    after the other
+    """
+    if backend is None:
+        backend = backends.open_backend('arcpy')
+
+    if engine == 'arcpy' and backend.name != 'arcpy':
+        raise ValueError("engine = arcpy needs backend = arcpy, use engine = numpy with the {} backend"
+                         .format(backend.name))
+
+    if engine == 'arcpy' and not all(isinstance(x, str) for r in rasters for x in [r.zone, r.value]):
+        raise ValueError("engine = arcpy needs raster_functions = mosaic, ZonalStatisticsAsTable reads the mosaics")
+
+    if engine == 'arcpy' and coverage != 'center':
+        raise ValueError("coverage = {} needs engine = numpy, the arcpy engine masks by cell center".format(coverage))
 
     # this is the shapefile after being projected
     final_aoi = layer.final_aoi
 
-    # get the range of features to run
-    start_id = 0
-    end_id = int(arcpy.GetCount_management(final_aoi).getOutput(0))
+    # one hash per feature, the FIDs of the final aoi are the feature ids
+    geometry_hashes = backend.geometry_hashes(final_aoi)
+    logging.info("Number of features: {}".format(len(geometry_hashes)))
+
+    manifest = checkpoint.Manifest(checkpoint.manifest_path(database_name))
+    inputs_hashes = {}
+    for raster in rasters:
+        # cells=feature: every feature has its own cells, results of runs that gave each cell to only one of the
+        # features overlapping it are not reused, they would leave the neighbours of a changed feature stale
+        params = dict(run_params or {}, analysis=raster.analysis, engine=engine, backend=backend.name,
+                      coverage=coverage, cells='feature')
+
+        # expressions are hashed on their source rasters and on what they compute
+        for name, raster_input in [('zone', raster.zone), ('value', raster.value)]:
+            if not isinstance(raster_input, str):
+                params[name] = repr(raster_input)
+
+        paths = raster_algebra.sources([raster.zone, raster.value])
+        inputs_hashes[raster.analysis] = checkpoint.inputs_hash(paths, params)
+
+    feature_ids = checkpoint.pending_features(manifest, inputs_hashes, geometry_hashes, run_mode)
+    logging.info("{} of {} features to run ({})".format(len(feature_ids), len(geometry_hashes), run_mode))
+
+    if run_mode != 'fresh':
+        store = result_store.open_store(database_name, result_backend)
+
+        # results of arcpy workers from a run that stopped before they were merged
+        result_store.merge_stores(store, result_store.leftover_parts(database_name, result_backend), result_backend)
+
+        # drop the old rows of features that run again and of features that are gone from the aoi
+        for raster in rasters:
+            stale = checkpoint.stale_features(manifest, raster.analysis, geometry_hashes)
+            store.delete_ids(raster.analysis, feature_ids + stale)
+            manifest.forget(stale, raster.analysis)
+
+        store.close()
+
+    footprints = None
+    if feature_ids:
+        footprints = footprint_index(backend, rasters)
+        feature_bounds = backend.feature_bounds(final_aoi, raster_algebra.sources([rasters[0].zone])[0])
+        feature_ids, empty_ids = spatial_index.split_empty(feature_bounds, feature_ids, footprints)
+
+        if empty_ids:
+            logging.info("{} features do not overlap the rasters, reported empty".format(len(empty_ids)))
+            report.count('empty_features', len(empty_ids))
+            for raster in rasters:
+                manifest.mark_done(empty_ids, raster.analysis, inputs_hashes[raster.analysis], geometry_hashes)
+
+    if not feature_ids:
+        manifest.close()
+        return
+
+    if engine == 'numpy':
+        zstats_numpy(backend, final_aoi, [r.value for r in rasters], rasters[0].zone, [r.analysis for r in rasters],
+                     database_name, feature_ids, workers, tile_size, max_memory_mb, result_backend, chunk_size,
+                     manifest, inputs_hashes, geometry_hashes, coverage, footprints, tile_cache_mb > 0, queue_depth)
+        manifest.close()
+
+        if tile_cache_mb > 0:
+            tile_cache.evict(tile_cache_mb)
+        return
+
+    manifest.close()
+
+    for raster in rasters:
+        checkpoint_info = (checkpoint.manifest_path(database_name), inputs_hashes[raster.analysis], geometry_hashes)
 
-    start = start_id
-    stop = end_id
+        if workers > 1:
+            # each worker gets its own mask, scratch workspace, output tables and store, merged in worker order
+            chunks = split_ids(feature_ids, n_chunks=workers)
+            part_names = [result_store.part_name(database_name, n) for n in range(len(chunks))]
+            jobs = [(chunk, final_aoi, raster.cellsize, raster.value, raster.zone, raster.analysis, part_names[n], n,
+                     result_backend, checkpoint_info, queue_depth) for n, chunk in enumerate(chunks)]
 
-    logging.info("Number of features: {}".format(end_id))
-    zstats_subprocess = zstats(start_id, end_id, layer.final_aoi, raster.cellsize, raster.value, raster.zone, raster.analysis, database_name)
+            with ProcessPoolExecutor(max_workers=workers, initializer=workspace.set_job_dir,
+                                     initargs=(workspace.job_dir(),)) as executor:
+                for timings in executor.map(_zstats_worker, jobs):
+                    report.merge(timings)
 
-    # run using python3
-    executable = sys.executable
+            store = result_store.open_store(database_name, result_backend)
+            result_store.merge_stores(store, part_names, result_backend)
+            store.close()
 
-    script_cmd = [executable, zstats_subprocess, raster.value,
-                  raster.zone, layer.final_aoi, raster.cellsize, raster.analysis]
\ No newline at end of file
+        else:
+            zstats(feature_ids, final_aoi, raster.cellsize, raster.value, raster.zone, raster.analysis,
+                   database_name, None, result_backend, checkpoint_info, queue_depth)
@@ -1,41 +1,99 @@
 import os
+import argparse
 import datetime
-import sys
 import logging
 import configparser
-import arcpy
-from data_types.layer import Layer
-from data_types.raster import Raster
-from raster_functions import raster_prep
-from utilities import zstats_handler, post_processing, prep_shapefile
-
-# get user inputs from config file:
-config_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "config_file.ini")
-config = configparser.ConfigParser()
-config.read(config_file)
-config_dict = config['inputs']
-
-log_file = config_dict['log_file']
-logging.basicConfig(filename=log_file, level=logging.INFO, format='%(asctime)s %(message)s', datefmt='%m/%d/%Y %I:%M:%S %p')
-logging.getLogger().addHandler(logging.StreamHandler())
-
-start = datetime.datetime.now()
-logging.info("\n\n{} BEGINNING LOG {}".format('='*5, '='*5))
-
-# analysis: forest_extent, forest_loss, biomass_weight, emissions
-analysis = [x.strip() for x in config_dict['analysis'].split(",")]
-shapefile = config_dict['shapefile']
-threshold = config_dict['threshold']
-tcd_categorized = config_dict['tcd_categorized']
-geodatabase = config_dict['geodatabase']
-user_def_column_name = config_dict['user_def_column_name']
-col_name = "FID"  # if this is in a gdb, make sure it assigns it OBJECT_ID
-output_file_name = config_dict['output_file_name']
-intersect = config_dict['intersect']
+from utilities import instrumentation, workspace
+from utilities.instrumentation import report
+
+# the config file of a single run
+CONFIG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "config_file.ini")
+
+
+def read_config(config_file=CONFIG_FILE, section='inputs'):
+    """
+    Settings of a run from section of config_file, see parse_settings
+    """
+    config = configparser.ConfigParser()
+    if not config.read(config_file):
+        raise IOError("config file {} not found, copy config_file.ini.sample to it".format(config_file))
+
+    return parse_settings(config[section])
+
+
+def setup_logging(log_file):
+    logging.basicConfig(filename=log_file, level=logging.INFO, format='%(asctime)s %(message)s',
+                        datefmt='%m/%d/%Y %I:%M:%S %p')
+    logging.getLogger().addHandler(logging.StreamHandler())
+
+
+def parse_settings(config_dict):
+    """
+    Settings of a run as a dict, from a section of a config file (or any dict of strings with the same keys).
+    Optional settings get their defaults
+    """
+    settings = dict(
+        log_file=config_dict['log_file'],
+        # analysis: forest_extent, forest_loss, biomass_weight, emissions
+        analysis=[x.strip() for x in config_dict['analysis'].split(",")],
+        shapefile=config_dict['shapefile'],
+        threshold=config_dict['threshold'],
+        tcd_categorized=config_dict['tcd_categorized'],
+        # several thresholds (10, 30, all...) from one run: the results are kept per raw tcd and each threshold is
+        # derived from them, threshold and tcd_categorized are then ignored
+        thresholds=[x.strip() for x in config_dict.get('thresholds', '').split(",") if x.strip()],
+        geodatabase=config_dict['geodatabase'],
+        user_def_column_name=config_dict['user_def_column_name'],
+        col_name="FID",  # if this is in a gdb, make sure it assigns it OBJECT_ID
+        output_file_name=config_dict['output_file_name'],
+        intersect=config_dict['intersect'],
+        # yes: the pieces of the intersect are dissolved on intersect_col. no: they are kept and their results summed
+        # per intersect_col group
+        dissolve=config_dict.get('dissolve', 'yes'),
+        # levels to sum the results of the features by, separated by ;, each a comma separated list of columns. One
+        # result file per level, from one zonal stats run
+        group_levels=[[x.strip() for x in level.split(',') if x.strip()]
+                      for level in config_dict.get('group_levels', '').split(';') if level.strip()],
+        # arcpy: mosaics in a file geodatabase. gdal: GeoTIFF/VRT files in the geodatabase folder, read with rasterio
+        backend=config_dict.get('backend', 'arcpy'),
+        # mosaic: Remap/Arithmetic functions are applied to the mosaics. numpy: applied window by window to plain
+        # rasters
+        raster_functions=config_dict.get('raster_functions', 'mosaic'),
+        # numpy: all features in one raster pass. arcpy: ZonalStatisticsAsTable once per feature (handles overlaps)
+        engine=config_dict.get('engine', 'numpy'),
+        # center: a cell counts for the feature holding its center. exact: cells are weighted by the fraction each
+        # feature covers (numpy engine)
+        coverage=config_dict.get('coverage', 'center'),
+        # numpy engine reads the rasters in tile_size x tile_size windows, shrunk to fit max_memory_mb
+        tile_size=int(config_dict.get('tile_size', 4096)),
+        max_memory_mb=int(config_dict.get('max_memory_mb', 2048)),
+        # number of processes to split the features across
+        workers=int(config_dict.get('workers', 1)),
+        # sqlite, or parquet to write the zonal stats results as parquet files
+        result_backend=config_dict.get('result_backend', 'sqlite'),
+        # numpy engine commits results and marks features done in the manifest every chunk_size features
+        chunk_size=int(config_dict.get('chunk_size', 1000)),
+        # size of the cache of projected/intersected aois in the cache folder, 0 turns it off
+        aoi_cache_mb=int(config_dict.get('aoi_cache_mb', 2048)),
+        # size of the cache of zone codes and values in the cache folder (numpy engine), 0 turns it off
+        tile_cache_mb=int(config_dict.get('tile_cache_mb', 0)),
+        # windows read ahead of the zonal stats and results waiting to be written, 0 runs the stages one after the
+        # other
+        queue_depth=int(config_dict.get('queue_depth', 2)),
+        # csv, or parquet for the result file
+        output_format=config_dict.get('output_format', 'csv'),
+        # none, cprofile or tracemalloc. The profile is written next to the run report in the result folder
+        profile=config_dict.get('profile', 'none'))
+
+    area, forest, biomass, tcd, loss, database_name, intersect_col = initInputRasterVariable(config_dict)
+    settings.update(area=area, forest=forest, biomass=biomass, tcd=tcd, loss=loss, database_name=database_name,
+                    intersect_col=intersect_col)
+
+    return settings
+
 
 # Create a handler for default input config file
-def initInputRasterVariable():
-    global area, forest, biomass, tcd, loss, database_name, intersect_col
+def initInputRasterVariable(config_dict):
     database_name = config_dict['database_name']
     intersect_col = config_dict['intersect_col']
     intersect_col = [x.strip() for x in intersect_col.split(',')]
@@ -83,64 +141,249 @@ def initInputRasterVariable():
 
     return area, forest, biomass, tcd, loss, database_name, intersect_col
 
-initInputRasterVariable()
-logging.info("intersect_col: {}".format(intersect_col))
-logging.info("Categorizing TCD? {}".format(tcd_categorized))
-logging.info("Area defined as = {}".format(area))
-logging.info("Forest Extent defined as = {}".format(forest))
-logging.info("Forest Loss defined as = {}".format(loss))
-logging.info("Biomass defined as = {}".format(biomass))
+def join_thresholds(l, thresholds, user_def_column_name, output_file_name, output_format='csv', aoi_df=None):
+    """
+    Write one result file per threshold, <output_file_name>_tcd<threshold>, each derived from the raw tcd results
+    """
+    from utilities import post_processing
+
+    names = [x for x in ['emissions', 'forest_loss', 'biomass_weight', 'forest_extent'] if getattr(l, x) is not None]
+    tables = {name: post_processing.threshold_tables(getattr(l, name), thresholds) for name in names}
+
+    for t in thresholds:
+        for name in names:
+            setattr(l, name, tables[name][t])
+
+        with report.stage('join', threshold=t):
+            l.join_tables('yes', t, user_def_column_name, '{}_tcd{}'.format(output_file_name, t), output_format,
+                          aoi_df=aoi_df)
+
+
+def join_outputs(l, s, output_file_name, aoi_df=None):
+    """
+    Write the result file of the tables of l, or one per threshold when thresholds is set
+    """
+    if s['thresholds']:
+        join_thresholds(l, s['thresholds'], s['user_def_column_name'], output_file_name, s['output_format'], aoi_df)
+    else:
+        with report.stage('join'):
+            l.join_tables(s['tcd_categorized'], s['threshold'], s['user_def_column_name'], output_file_name,
+                          s['output_format'], aoi_df=aoi_df)
+
+
+def join_levels(l, s, levels):
+    """
+    Sum the results of the features per group of each level and write one result file per level, named
+    <output_file_name>_<columns> when there are several levels. l keeps the results per feature
+    """
+    from utilities import zonal_engine
+
+    names = [x for x in ['emissions', 'forest_loss', 'biomass_weight', 'forest_extent'] if getattr(l, x) is not None]
+    feature_tables = {name: getattr(l, name) for name in names}
+
+    for columns in levels:
+        with report.stage('group', level=','.join(columns)):
+            feature_groups, group_df = l.feature_groups(columns)
+            for name in names:
+                setattr(l, name, zonal_engine.group_table(feature_tables[name], feature_groups))
+
+        output_file_name = s['output_file_name']
+        if len(levels) > 1:
+            output_file_name = '{}_{}'.format(output_file_name, '_'.join(columns))
+
+        join_outputs(l, s, output_file_name, group_df)
+
+    for name in names:
+        setattr(l, name, feature_tables[name])
+
+
+def run(settings, run_mode='fresh', job_dir=None):
+    """
+    Run zonal stats and write the result file, the programmatic entry point. Several runs can be made from one
+    process (see batch.py), and they share its imported modules, open rasters, remap lookups and the aoi and tile
+    caches
+    :param settings: dict from read_config or parse_settings
+    :param run_mode: fresh, resume or incremental, like the --resume and --incremental options
+    :param job_dir: folder for the tables, shapefile and result folders of this run, the repository folder if None
+    :return: the Layer, with the result tables of each analysis
+    """
+    s = settings
+    previous_job_dir = workspace.job_dir()
+    workspace.set_job_dir(job_dir)
+
+    # each run has its own report
+    report.drain()
+
+    try:
+        return _run(s, run_mode)
+    finally:
+        workspace.set_job_dir(previous_job_dir)
+
+
+def _run(s, run_mode):
+    # pandas, geopandas and the backend (arcpy or rasterio) are imported when a run starts and not with this module,
+    # so reading the config, --help and the worker processes that import this module again start fast
+    import backends
+    from data_types.layer import Layer
+    from data_types.raster import Raster, group_by_zone
+    from utilities import aoi_cache, post_processing, prep_shapefile, zstats_handler
+
+    start = datetime.datetime.now()
+    logging.info("\n\n{} BEGINNING LOG {}".format('='*5, '='*5))
+
+    profiler = instrumentation.Profiler(s['profile'])
+    profiler.start()
+
+    database_name, intersect_col = s['database_name'], s['intersect_col']
+    threshold, tcd_categorized, thresholds = s['threshold'], s['tcd_categorized'], s['thresholds']
+    logging.info("intersect_col: {}".format(intersect_col))
+    logging.info("Categorizing TCD? {}".format(tcd_categorized))
+    logging.info("Thresholds from one run: {}".format(thresholds))
+    logging.info("Area defined as = {}".format(s['area']))
+    logging.info("Forest Extent defined as = {}".format(s['forest']))
+    logging.info("Forest Loss defined as = {}".format(s['loss']))
+    logging.info("Biomass defined as = {}".format(s['biomass']))
+    logging.info("Raster backend: {}".format(s['backend']))
+    logging.info("Raster functions: {}".format(s['raster_functions']))
+    logging.info("Zonal stats engine: {}".format(s['engine']))
+    logging.info("Workers: {}".format(s['workers']))
+    logging.info("Coverage: {}".format(s['coverage']))
+    logging.info("Dissolve: {}, group levels: {}".format(s['dissolve'], s['group_levels']))
+    logging.info("Run mode: {}".format(run_mode))
+    logging.info("Job folder: {}".format(workspace.job_dir()))
+
+    # delete existing database so duplicate data isn't appended. resume and incremental runs keep it and only
+    # replace the rows of the features they run again
+    if run_mode == 'fresh':
+        prep_shapefile.delete_database(database_name)
+
+    # if user requests emissions analysis, need to runs 2 zonal stats, one min, one max.
+    analysis_requested = prep_shapefile.build_analysis(list(s['analysis']))
+
+    # remap the tcd mosaic and apply a raster function that adds tcd + loss year mosaics
+    # raster_prep.remap_threshold(geodatabase, threshold)
+
+    # arcpy is only imported if the arcpy backend is used
+    raster_backend = backends.open_backend(s['backend'])
+
+    # create layer object. this just sets up the properties that will later be filled in for each analysis
+
+    # set final aoi equal to the shapefile or intersect result if provided
+    shapefile, intersect = s['shapefile'], s['intersect']
+    shapefile_dir = workspace.folder("shapefile")
+    out_final_aoi = os.path.join(shapefile_dir, "final_aoi.shp")
+
+    if intersect:
+        l = Layer(out_final_aoi, intersect_col)
+        sources = [shapefile, intersect]
+    else:
+        l = Layer(shapefile, s['col_name'])
+        sources = [shapefile]
+
+    # the projected (and intersected) aoi is cached on the content of its sources, so runs that only change the
+    # threshold or analysis skip the projection and overlay. aoi_cache_mb = 0 neither reads nor writes the cache
+    use_aoi_cache = s['aoi_cache_mb'] > 0
+    l.final_aoi = None
+    if use_aoi_cache:
+        aoi_key = aoi_cache.cache_key(sources, {'intersect_col': intersect_col if intersect else None,
+                                                'dissolve': s['dissolve'] if intersect else None,
+                                                'out_cs': l.out_cs, 'backend': s['backend']})
+        l.final_aoi = aoi_cache.lookup(aoi_key, l.projected_aoi)
+
+    if l.final_aoi is None:
+        if intersect:
+            with report.stage('intersect'):
+                raster_backend.intersect(shapefile, intersect, intersect_col, shapefile_dir, out_final_aoi,
+                                         s['dissolve'] != 'no')
+        l.final_aoi = l.source_aoi
+        with report.stage('projection'):
+            l.project_source_aoi(raster_backend)
+        if use_aoi_cache:
+            aoi_cache.store(aoi_key, l.final_aoi, s['aoi_cache_mb'])
+
+    logging.info("FINAL LAYER AOI: {}".format(l.final_aoi))
+
+    # without the dissolve the results of the pieces are summed per group, where features of the shapefile overlap
+    # each other that would count their overlap once per piece instead of once per group
+    if intersect and s['dissolve'] == 'no':
+        with report.stage('intersect', check='overlaps'):
+            overlaps = l.overlapping_groups(intersect_col)
+        if len(overlaps):
+            raise ValueError("features of {} overlap each other in {} {} groups, e.g. {}. With dissolve = no their "
+                             "overlap would be counted once per feature, set dissolve = yes"
+                             .format(shapefile, len(overlaps), ', '.join(intersect_col),
+                                     overlaps.head(3).to_dict('records')))
+
+    # results of a previous run are only reused if these match. With several thresholds the zone is raw tcd
+    # whatever the thresholds, so a resumed run can add a threshold without running zonal stats again
+    zone_threshold, zone_tcd_categorized = ('none', 'no') if thresholds else (threshold, tcd_categorized)
+    run_params = {'threshold': zone_threshold, 'tcd_categorized': zone_tcd_categorized}
+
+    # create a raster object per analysis. If forest_loss or biomass_weight, will just be one analysis. if emissions,
+    # need to run forest_loss and emissions. Analyses that share a zone raster (forest_loss and emissions both use
+    # loss) are run together so the zone raster is only read once
+    rasters = [Raster(analysis_name, s['geodatabase'], s['area'], s['forest'], s['loss'], s['tcd'], s['biomass'],
+                      s['raster_functions'], zone_threshold, zone_tcd_categorized)
+               for analysis_name in analysis_requested]
+
+    for raster_group in group_by_zone(rasters):
 
-# delete existing database so duplicate data isn't appended
-prep_shapefile.delete_database(database_name)
+        # run zstats, put results into the result store.
+        zstats_handler.main_script(l, raster_group, database_name, s['engine'], s['workers'], s['tile_size'],
+                                   s['max_memory_mb'], s['result_backend'], run_mode, s['chunk_size'], run_params,
+                                   raster_backend, s['coverage'], s['tile_cache_mb'], s['queue_depth'])
 
-# if user requests emissions analysis, need to runs 2 zonal stats, one min, one max.
-analysis_requested = prep_shapefile.build_analysis(analysis)
+        for r in raster_group:
+            # get results from the result store to pandas df
+            with report.stage('db_to_df', analysis=r.analysis):
+                r.db_to_df(l, database_name, s['result_backend'])
 
-# remap the tcd mosaic and apply a raster function that adds tcd + loss year mosaics
-# raster_prep.remap_threshold(geodatabase, threshold)
+            # this roughly translate to layer.analysis_name == r.df
+            # or forest_loss = pd.DataFrame(forestlossdata). It gives the resulting dataframe the name of the analysis
+            # and sets it as the attribute l.forest_loss, l.emissions, which are the dataframes
+            setattr(l, r.analysis, r.df)
 
-# create layer object. this just sets up the properties that will later be filled in for each analysis
+    if l.emissions is not None:
+        print("converting biomass to emissions")
+        l.emissions = post_processing.biomass_to_mtc02(l)
 
-# set final aoi equal to the shapefile or intersect result if provided
-workspace = os.path.join(os.path.dirname(os.path.realpath(__file__)), "shapefile")
-out_final_aoi = os.path.join(workspace, "final_aoi.shp")
+    # the undissolved pieces of the intersect are summed per intersect_col group, unless other levels are given
+    levels = s['group_levels']
+    if not levels and intersect and s['dissolve'] == 'no':
+        levels = [intersect_col]
 
-if intersect:
-    prep_shapefile.intersect_gp(shapefile, intersect, intersect_col, workspace, out_final_aoi)
-    l = Layer(out_final_aoi, intersect_col)
-    l.final_aoi = out_final_aoi
-    l.project_source_aoi()
-else:
-    l = Layer(shapefile, col_name)
-    l.final_aoi = shapefile
-    l.project_source_aoi()
+    # join possible tables (loss, emissions, extent, etc) and decode to loss year, tcd
+    if levels:
+        join_levels(l, s, levels)
+    else:
+        join_outputs(l, s, s['output_file_name'])
+    logging.info(("elapsed time: {}".format(datetime.datetime.now() - start)))
 
-logging.info("FINAL LAYER AOI: {}".format(l.final_aoi))
+    # per stage timings and percentiles, next to the result file
+    out_report = instrumentation.report_path(l.root_dir, s['output_file_name'])
+    report.write(out_report)
+    profiler.stop(out_report)
+    logging.info("run report written to {}.json".format(out_report))
 
-# loop over the analysis. If forest_loss or biomass_weight, will just be one analysis. if emissions, need to
-# run forest_loss and emissions
+    return l
 
-for analysis_name in analysis_requested:
 
-    # create raster object.
-    r = Raster(analysis_name, geodatabase, area, forest, loss, tcd, biomass)
+# worker processes re-import this module, so the run itself only happens when executed as a script
+def main():
+    parser = argparse.ArgumentParser(description="zonal stats of forest loss, extent and emissions")
+    parser.add_argument('--resume', action='store_true',
+                        help="skip features already done with the same inputs in the previous run")
+    parser.add_argument('--incremental', action='store_true',
+                        help="like --resume, and also rerun features whose geometry changed in the shapefile")
+    args = parser.parse_args()
 
-    # run zstats, put results into sql db.
-    zstats_handler.main_script(l, r, database_name)
+    run_mode = 'incremental' if args.incremental else 'resume' if args.resume else 'fresh'
 
-    # get results from sql to pandas df
-    r.db_to_df(l, database_name)
+    settings = read_config()
+    setup_logging(settings['log_file'])
 
-    # this roughly translate to layer.analysis_name == r.df
-    # or forest_loss = pd.DataFrame(forestlossdata). It gives the resulting dataframe the name of the analysis and sets
-    # it as the attribute l.forest_loss, l.emissions, which are the dataframes
-    setattr(l, analysis_name, r.df)
+    run(settings, run_mode)
 
-if l.emissions is not None:
-    print("converting biomass to emissions")
-    l.emissions = post_processing.biomass_to_mtc02(l)
 
-# join possible tables (loss, emissions, extent, etc) and decode to loss year, tcd
-l.join_tables(tcd_categorized, threshold, user_def_column_name, output_file_name)
-logging.info(("elapsed time: {}".format(datetime.datetime.now() - start)))
\ No newline at end of file
+if __name__ == '__main__':
+    main()